@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+"""
+gphotosdl Benchmarks
+Runs PhotoDownloader end to end against the fake Photos Library API
+(fake_photos_api.py) and reports, for each phase of the run, items/sec,
+MB/s, API calls and peak RSS.
+
+Each scenario gets a fresh fake library and a fresh temporary working
+directory, so catalog, journal and output never carry over between them.
+
+Usage: python benchmark.py [--scenario NAME ...] [--scale 2] [--json results.json]
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import gphotosdl
+from fake_photos_api import FakeLibrary, FakePhotosServer
+
+MB = 1024 * 1024
+RSS_INTERVAL = 0.05  # Seconds between memory samples
+UNTHROTTLED_LIMITS = {name: (10000.0, 10000, concurrency)
+                      for name, (_, _, concurrency) in gphotosdl.ENDPOINT_LIMITS.items()}
+
+# name: (description, library options, server options, downloader options, run options)
+SCENARIOS = {
+    'baseline': ('plain listing, small files',
+                 dict(items=2000, albums=20, album_size=50, file_size=256 * 1024), {}, {}, {}),
+    'pipelined': ('album and library scans overlapped (--pipeline)',
+                  dict(items=2000, albums=20, album_size=50, file_size=256 * 1024), {}, {},
+                  dict(pipeline=True)),
+    'sharded': ('library listed in parallel date shards (--shard-library)',
+                dict(items=2000, albums=20, album_size=50, file_size=256 * 1024), {},
+                dict(shard_library=True), {}),
+    'latency': ('50 ms added to every response',
+                dict(items=1000, albums=10, album_size=50, file_size=256 * 1024),
+                dict(latency=0.05), dict(download_workers=16, max_in_flight=32), {}),
+    'throttled': ('5% of requests answered 429',
+                  dict(items=1000, albums=10, album_size=50, file_size=256 * 1024),
+                  dict(error_rate=0.05, retry_after=0), {}, {}),
+    'large-files': ('a few 300 MB videos, fetched in byte ranges',
+                    dict(items=200, albums=4, album_size=25, file_size=256 * 1024, large_files=3),
+                    {}, dict(range_segments=4), {}),
+    'rerun': ('second run over an unchanged library',
+              dict(items=2000, albums=20, album_size=50, file_size=256 * 1024), {}, {},
+              dict(runs=2)),
+}
+
+
+class StaticAuth:
+    """Stands in for GoogleAuth with a fixed token the fake server accepts"""
+    token = 'benchmark-token'
+    refresh_token = None
+
+    def stop_auto_refresh(self):
+        pass
+
+
+class RssSampler:
+    """Samples this process's resident set size on a background thread"""
+    def __init__(self, interval=RSS_INTERVAL):
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+
+    def peak(self, start, end):
+        """Largest RSS sampled between start and end, or None
+
+        A window shorter than the sampling interval gets the first sample
+        taken after it started.
+        """
+        values = [rss for when, rss in self.samples if start <= when <= end]
+        if not values:
+            values = [rss for when, rss in self.samples if when >= start][:1]
+        return max(values) if values else None
+
+    def _run(self):
+        while True:
+            rss = current_rss()
+            if rss is None:
+                return
+            self.samples.append((time.time(), rss))
+            if self._stop.wait(self.interval):
+                return
+
+
+def current_rss():
+    """Resident set size in bytes (Linux only; None elsewhere)"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+def record_calls(downloader):
+    """Wrap the downloader's scheduler to log (time, endpoint) per request"""
+    calls = []
+    call = downloader.scheduler.call
+
+    def logged(endpoint, fn):
+        def attempt():
+            calls.append((time.time(), endpoint))
+            return fn()
+        return call(endpoint, attempt)
+
+    downloader.scheduler.call = logged
+    return calls
+
+
+def run_scenario(name, scale=1.0, unthrottled=False):
+    """Run one scenario in a scratch directory and return its measurements"""
+    description, library_options, server_options, downloader_options, run_options = SCENARIOS[name]
+    library_options = dict(library_options, items=max(1, int(library_options['items'] * scale)),
+                           albums=max(1, int(library_options['albums'] * scale)))
+    runs = run_options.get('runs', 1)
+
+    server = FakePhotosServer(FakeLibrary(**library_options), **server_options).start()
+    workdir = tempfile.mkdtemp(prefix='gphotosdl-bench-')
+    cwd = os.getcwd()
+    api_base = gphotosdl.API_BASE
+    try:
+        os.chdir(workdir)
+        gphotosdl.API_BASE = server.api_base
+        for run in range(runs):
+            before = server.stats()
+            downloader = gphotosdl.PhotoDownloader(auth=StaticAuth(), **downloader_options)
+            if unthrottled:
+                downloader.scheduler = gphotosdl.RequestScheduler(UNTHROTTLED_LIMITS,
+                                                                  metrics=downloader.metrics)
+            calls = record_calls(downloader)
+            downloaded_before = len(downloader.downloaded)
+
+            started = time.time()
+            with RssSampler() as rss:
+                downloader.run('unfiled_photos.zip', pipeline=run_options.get('pipeline', False))
+            finished = time.time()
+            downloaded = len(downloader.downloaded) - downloaded_before
+            downloader.close()
+    finally:
+        gphotosdl.API_BASE = api_base
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+        server.shutdown()
+        server.server_close()
+
+    # Measurements are for the last run only
+    after = server.stats()
+    served = after['bytes_served'] - before['bytes_served']
+    listed = after['items_listed'] - before['items_listed']
+    phase_items = {'album scan': len(downloader.filed_ids), 'library scan': listed,
+                   'download': downloaded}
+
+    phases = []
+    for phase, (start, end) in sorted(downloader.phases.phases.items(), key=lambda p: p[1][0]):
+        end = end or finished
+        elapsed = max(end - start, 1e-9)
+        counts = {}
+        for when, endpoint in calls:
+            if start <= when <= end:
+                counts[endpoint] = counts.get(endpoint, 0) + 1
+        items = phase_items.get(phase, 0)
+        phases.append({
+            'phase': phase,
+            'seconds': round(elapsed, 3),
+            'items': items,
+            'items_per_sec': round(items / elapsed, 1),
+            'mb_per_sec': round(served / MB / elapsed, 2) if phase == 'download' else None,
+            'api_calls': counts,
+            'peak_rss_mb': _mb(rss.peak(start, end)),
+        })
+
+    return {
+        'scenario': name,
+        'description': description,
+        'items': library_options['items'],
+        'seconds': round(finished - started, 3),
+        'downloaded': downloaded,
+        'mb_downloaded': round(served / MB, 1),
+        'server_calls': {route: count - before['calls'].get(route, 0)
+                         for route, count in after['calls'].items()},
+        'peak_rss_mb': _mb(rss.peak(started, finished)),
+        'phases': phases,
+    }
+
+
+def _mb(value):
+    return round(value / MB, 1) if value is not None else None
+
+
+def print_result(result):
+    print(f"\n{result['scenario']}: {result['description']} ({result['items']} items)")
+    print(f"  {'phase':<14} {'time':>8} {'items':>7} {'items/s':>9} {'MB/s':>8} {'peak RSS':>10}  API calls")
+    for phase in result['phases']:
+        mb_per_sec = f"{phase['mb_per_sec']:.1f}" if phase['mb_per_sec'] is not None else '-'
+        rss = f"{phase['peak_rss_mb']:.1f} MB" if phase['peak_rss_mb'] is not None else '-'
+        calls = ', '.join(f"{endpoint} {count}" for endpoint, count in sorted(phase['api_calls'].items()))
+        print(f"  {phase['phase']:<14} {phase['seconds']:>7.2f}s {phase['items']:>7} "
+              f"{phase['items_per_sec']:>9.1f} {mb_per_sec:>8} {rss:>10}  {calls or '-'}")
+    print(f"  {'wall clock':<14} {result['seconds']:>7.2f}s {result['downloaded']:>7} downloaded, "
+          f"{result['mb_downloaded']} MB; server saw {result['server_calls']}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark gphotosdl against a local fake Photos API')
+    parser.add_argument('--scenario', action='append', choices=list(SCENARIOS),
+                        help='scenario to run; repeat for several (default: all)')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='multiply each scenario\'s library size by this (default: 1)')
+    parser.add_argument('--unthrottled', action='store_true',
+                        help='lift the client-side request rate limits to measure raw throughput')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also write the results to FILE as JSON, e.g. to compare runs')
+    parser.add_argument('--verbose', action='store_true', help='show the downloader\'s own output')
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    # The downloader logs to the gphotosdl logger; only warnings unless --verbose
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, format='%(message)s')
+    results = []
+    for name in args.scenario or SCENARIOS:
+        result = run_scenario(name, scale=args.scale, unthrottled=args.unthrottled)
+        print_result(result)
+        results.append(result)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nResults written to {args.json}")
+
+if __name__ == '__main__':
+    sys.exit(main())
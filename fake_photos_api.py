@@ -0,0 +1,374 @@
+#!/usr/bin/env python
+"""
+Fake Google Photos Library API
+Local stand-in for the parts of the API gphotosdl.py uses, for testing and
+benchmarks (see benchmark.py) without a Google account or quota.
+
+Serves /v1/albums, /v1/mediaItems (list and get), /v1/mediaItems:search
+(by album and by date), /v1/mediaItems:batchGet and the media bytes behind
+each baseUrl, with Range/If-Range support and expiring baseUrls. The
+library is synthetic and deterministic for a given seed; its size, album
+overlap, page sizes, latency, 429 injection and large files are all
+configurable.
+
+Usage: python fake_photos_api.py --items 10000 --albums 50
+Any bearer token is accepted.
+"""
+
+import argparse
+import datetime
+import hashlib
+import http.server
+import json
+import random
+import sys
+import threading
+import time
+import urllib.parse
+
+# Configuration
+PORT = 8765
+ITEMS = 5000
+ALBUMS = 20
+ALBUM_SIZE = 100
+ALBUM_OVERLAP = 0.2  # Share of each album's items that are also in another album
+DUPLICATE_RATE = 0.01  # Share of items whose bytes repeat another item's
+VIDEO_RATE = 0.05
+FILE_SIZE = 2 * 1024 * 1024  # Mean size of an ordinary item
+LARGE_FILES = 0  # Videos of LARGE_SIZE bytes each
+LARGE_SIZE = 300 * 1024 * 1024
+MAX_PAGE_SIZE = 100  # The real API caps mediaItems pages at 100 and albums at 50
+MAX_ALBUM_PAGE_SIZE = 50
+URL_TTL = 3600  # Seconds a baseUrl stays valid
+PATTERN_SIZE = 64 * 1024  # Media bodies repeat a pattern of this many bytes
+CHUNK_SIZE = 1024 * 1024
+
+
+class FakeLibrary:
+    """Synthetic media library: items newest first, plus albums over them
+
+    Item bodies are never stored. Each is a pattern derived from the
+    item's content key, so any byte range can be produced on demand and
+    items sharing a key (duplicates) have identical bytes.
+    """
+    def __init__(self, items=ITEMS, albums=ALBUMS, album_size=ALBUM_SIZE, overlap=ALBUM_OVERLAP,
+                 duplicate_rate=DUPLICATE_RATE, video_rate=VIDEO_RATE, file_size=FILE_SIZE,
+                 large_files=LARGE_FILES, large_size=LARGE_SIZE, seed=1):
+        rnd = random.Random(seed)
+        start = datetime.datetime(2005, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+        span = datetime.datetime(2024, 12, 31, tzinfo=datetime.timezone.utc).timestamp() - start
+
+        self.items = []
+        for i in range(items):
+            video = i < large_files or rnd.random() < video_rate
+            size = large_size if i < large_files else max(1, int(rnd.expovariate(1.0 / file_size)))
+            created = datetime.datetime.fromtimestamp(start + rnd.random() * span, datetime.timezone.utc)
+            self.items.append({
+                'id': f'fake{i:08d}',
+                # Camera counters wrap, so filenames collide now and then
+                'filename': f"{'MVI' if video else 'IMG'}_{i % 9999:04d}.{'MP4' if video else 'JPG'}",
+                'mimeType': 'video/mp4' if video else 'image/jpeg',
+                'mediaMetadata': {'creationTime': created.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                                  'width': '4032', 'height': '3024'},
+                'size': size,
+                'content': f'fake{i:08d}',
+            })
+        for item in self.items[large_files:]:
+            if rnd.random() < duplicate_rate:
+                original = rnd.choice(self.items)
+                item['content'], item['size'] = original['content'], original['size']
+
+        self.items.sort(key=lambda item: item['mediaMetadata']['creationTime'], reverse=True)
+        self.by_id = {item['id']: item for item in self.items}
+
+        # Albums draw mostly fresh items, plus `overlap` of ones already
+        # filed; large files are left out so they are always downloaded
+        large = {f'fake{i:08d}' for i in range(large_files)}
+        unfiled = [item['id'] for item in self.items if item['id'] not in large]
+        rnd.shuffle(unfiled)
+        filed = []
+        self.albums = {}
+        for a in range(albums):
+            shared = min(int(album_size * overlap), len(filed))
+            ids = rnd.sample(filed, shared)
+            while len(ids) < album_size and unfiled:
+                ids.append(unfiled.pop())
+            filed.extend(ids[shared:])
+            self.albums[f'fakealbum{a:04d}'] = ids
+
+    def body(self, item, start, end):
+        """Yield bytes start..end-1 of an item's body in chunks"""
+        pattern = hashlib.sha256(item['content'].encode('utf-8')).digest() * (PATTERN_SIZE // 32)
+        pos = start
+        while pos < end:
+            offset = pos % PATTERN_SIZE
+            n = min(PATTERN_SIZE - offset, end - pos, CHUNK_SIZE)
+            yield pattern[offset:offset + n]
+            pos += n
+
+    def in_ranges(self, item, ranges):
+        day = tuple(int(part) for part in item['mediaMetadata']['creationTime'][:10].split('-'))
+        for r in ranges:
+            start, end = r.get('startDate', {}), r.get('endDate', {})
+            if ((start.get('year', 0), start.get('month', 0), start.get('day', 0)) <= day
+                    <= (end.get('year', 9999), end.get('month', 12), end.get('day', 31))):
+                return True
+        return False
+
+
+class FakePhotosServer(http.server.ThreadingHTTPServer):
+    """HTTP server for a FakeLibrary, with failure injection and counters
+
+    latency is added before every API response and before the first
+    byte of every media response. error_rate is the chance any request
+    is answered 429 with Retry-After: retry_after.
+    """
+    daemon_threads = True
+
+    def __init__(self, library, host='127.0.0.1', port=0, latency=0.0, error_rate=0.0,
+                 retry_after=1, max_page_size=MAX_PAGE_SIZE, url_ttl=URL_TTL, seed=1):
+        super().__init__((host, port), FakeApiHandler)
+        self.library = library
+        self.latency = latency
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.max_page_size = max_page_size
+        self.url_ttl = url_ttl
+        self.etag = '"v1"'
+        self.calls = {}
+        self.items_listed = 0  # Items returned by library listings and date searches
+        self.bytes_served = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    @property
+    def api_base(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/v1'
+
+    def start(self):
+        """Serve on a daemon thread and return self"""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def count(self, route, items=0, sent=0):
+        with self._lock:
+            self.calls[route] = self.calls.get(route, 0) + 1
+            self.items_listed += items
+            self.bytes_served += sent
+
+    def inject_error(self):
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-body is expected (cancelled downloads)
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def stats(self):
+        with self._lock:
+            return {'calls': dict(self.calls), 'items_listed': self.items_listed,
+                    'bytes_served': self.bytes_served}
+
+
+class FakeApiHandler(http.server.BaseHTTPRequestHandler):
+    """Routes requests for FakePhotosServer"""
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = 64 * 1024
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path.startswith('/media/'):
+            return self._media(url.path)
+        if not self._api_preamble():
+            return
+
+        library = self.server.library
+        if url.path == '/v1/albums':
+            ids = list(library.albums)
+            page, token = self._page(ids, query, MAX_ALBUM_PAGE_SIZE)
+            albums = [{'id': album_id, 'title': f'Album {album_id[-4:]}',
+                       'mediaItemsCount': str(len(library.albums[album_id]))} for album_id in page]
+            self.server.count('albums')
+            return self._send_json({'albums': albums}, token)
+        if url.path == '/v1/mediaItems':
+            page, token = self._page(library.items, query, self.server.max_page_size)
+            self.server.count('list', items=len(page))
+            return self._send_json({'mediaItems': [self._item_json(item) for item in page]}, token)
+        if url.path == '/v1/mediaItems:batchGet':
+            ids = query.get('mediaItemIds', [])
+            results = []
+            for item_id in ids:
+                item = library.by_id.get(item_id)
+                if item:
+                    results.append({'mediaItem': self._item_json(item)})
+                else:
+                    results.append({'status': {'code': 5, 'message': 'Not found'}})
+            self.server.count('batchGet', items=len(ids))
+            return self._send_json({'mediaItemResults': results})
+        if url.path.startswith('/v1/mediaItems/'):
+            item = library.by_id.get(url.path.rsplit('/', 1)[1])
+            self.server.count('get')
+            if item is None:
+                return self._send_error(404, 'Requested entity was not found.')
+            return self._send_json(self._item_json(item))
+        self._send_error(404, 'Not found')
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if not self._api_preamble():
+            return
+        if urllib.parse.urlsplit(self.path).path != '/v1/mediaItems:search':
+            return self._send_error(404, 'Not found')
+
+        library = self.server.library
+        size = min(int(body.get('pageSize', 25)), self.server.max_page_size)
+        if 'albumId' in body:
+            if body['albumId'] not in library.albums:
+                return self._send_error(404, 'Requested entity was not found.')
+            items = [library.by_id[item_id] for item_id in library.albums[body['albumId']]]
+        else:
+            ranges = body.get('filters', {}).get('dateFilter', {}).get('ranges', [])
+            items = [item for item in library.items if library.in_ranges(item, ranges)] if ranges else library.items
+        page, token = self._page(items, {'pageToken': [body.get('pageToken', '')], 'pageSize': [size]},
+                                 self.server.max_page_size)
+        if 'albumId' in body:
+            self.server.count('albumItems')
+        else:
+            self.server.count('search', items=len(page))
+        self._send_json({'mediaItems': [self._item_json(item) for item in page]}, token)
+
+    def _api_preamble(self):
+        """Apply latency, auth and error injection; False if answered already"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if not self.headers.get('Authorization', '').startswith('Bearer '):
+            self._send_error(401, 'Request is missing required authentication credential.')
+            return False
+        if self.server.inject_error():
+            self.server.count('throttled')
+            self._send_error(429, 'Quota exceeded.', {'Retry-After': str(self.server.retry_after)})
+            return False
+        return True
+
+    def _media(self, path):
+        # /media/<id>/<issued>=d or =dv
+        parts = path.split('/')
+        item = self.server.library.by_id.get(parts[2]) if len(parts) == 4 else None
+        if item is None:
+            return self._send_error(404, 'Not found')
+        if time.time() - int(parts[3].split('=')[0]) > self.server.url_ttl:
+            return self._send_error(403, 'baseUrl has expired')
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.inject_error():
+            self.server.count('throttled')
+            return self._send_error(429, 'Quota exceeded.', {'Retry-After': str(self.server.retry_after)})
+
+        size = item['size']
+        start, end = 0, size
+        range_header = self.headers.get('Range')
+        if range_header and self.headers.get('If-Range', self.server.etag) == self.server.etag:
+            first, last = range_header.split('=', 1)[1].split('-', 1)
+            start, end = int(first), min(int(last) + 1 if last else size, size)
+            self.send_response(206)
+            self.send_header('Content-Range', f'bytes {start}-{end - 1}/{size}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', item['mimeType'])
+        self.send_header('Content-Length', str(end - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', self.server.etag)
+        self.end_headers()
+        for chunk in self.server.library.body(item, start, end):
+            self.wfile.write(chunk)
+        self.server.count('media', sent=end - start)
+
+    def _page(self, seq, query, max_size):
+        start = int((query.get('pageToken') or [''])[0] or 0)
+        size = min(int((query.get('pageSize') or [25])[0]), max_size)
+        end = start + size
+        return seq[start:end], (str(end) if end < len(seq) else None)
+
+    def _item_json(self, item):
+        issued = int(time.time())
+        return {'id': item['id'], 'filename': item['filename'], 'mimeType': item['mimeType'],
+                'mediaMetadata': item['mediaMetadata'],
+                'baseUrl': f"http://{self.headers['Host']}/media/{item['id']}/{issued}"}
+
+    def _send_json(self, obj, next_page_token=None):
+        if next_page_token:
+            obj['nextPageToken'] = next_page_token
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, code, message, headers=None):
+        body = json.dumps({'error': {'code': code, 'message': message}}).encode('utf-8')
+        self.send_response(code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Serve a fake Google Photos Library API')
+    parser.add_argument('--port', type=int, default=PORT, help=f'port to listen on (default: {PORT})')
+    parser.add_argument('--items', type=int, default=ITEMS, help=f'media items in the library (default: {ITEMS})')
+    parser.add_argument('--albums', type=int, default=ALBUMS, help=f'albums (default: {ALBUMS})')
+    parser.add_argument('--album-size', type=int, default=ALBUM_SIZE,
+                        help=f'items per album (default: {ALBUM_SIZE})')
+    parser.add_argument('--overlap', type=float, default=ALBUM_OVERLAP,
+                        help=f'share of album items also in another album (default: {ALBUM_OVERLAP})')
+    parser.add_argument('--duplicate-rate', type=float, default=DUPLICATE_RATE,
+                        help=f'share of items with the same bytes as another (default: {DUPLICATE_RATE})')
+    parser.add_argument('--file-size', type=int, default=FILE_SIZE,
+                        help=f'mean item size in bytes (default: {FILE_SIZE})')
+    parser.add_argument('--large-files', type=int, default=LARGE_FILES,
+                        help='videos of --large-size bytes each (default: 0)')
+    parser.add_argument('--large-size', type=int, default=LARGE_SIZE,
+                        help=f'size of each large video in bytes (default: {LARGE_SIZE})')
+    parser.add_argument('--page-size', type=int, default=MAX_PAGE_SIZE,
+                        help=f'largest page returned for media item listings (default: {MAX_PAGE_SIZE})')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help='seconds added before each response (default: 0)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='chance of answering any request with 429 (default: 0)')
+    parser.add_argument('--retry-after', type=int, default=1,
+                        help='Retry-After seconds sent with injected 429s (default: 1)')
+    parser.add_argument('--url-ttl', type=int, default=URL_TTL,
+                        help=f'seconds before a baseUrl expires (default: {URL_TTL})')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the library (default: 1)')
+    return parser.parse_args(argv)
+
+def main():
+    args = parse_args()
+    library = FakeLibrary(items=args.items, albums=args.albums, album_size=args.album_size,
+                          overlap=args.overlap, duplicate_rate=args.duplicate_rate,
+                          file_size=args.file_size, large_files=args.large_files,
+                          large_size=args.large_size, seed=args.seed)
+    server = FakePhotosServer(library, port=args.port, latency=args.latency, error_rate=args.error_rate,
+                              retry_after=args.retry_after, max_page_size=args.page_size,
+                              url_ttl=args.url_ttl, seed=args.seed)
+    print(f"Serving {len(library.items)} items in {len(library.albums)} albums at {server.api_base}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(f"\nRequests served: {server.stats()['calls']}")
+
+if __name__ == '__main__':
+    main()
@@ -11,20 +11,94 @@ import json
 import urllib.request
 import urllib.parse
 import urllib.error
+import http.client
 import http.server
+import io
 import webbrowser
 import hashlib
 import base64
 import secrets
+import random
+import socket
+import email.utils
 import time
-from zipfile import ZipFile
+import datetime
+import argparse
+import logging
+import queue
+import threading
+import signal
+import sys
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import sqlite3
+import bisect
+import heapq
+import mmap
+import struct
+import zlib
+from array import array
+from zipfile import ZipFile, ZipInfo, BadZipFile, ZIP_STORED, ZIP_DEFLATED
 from urllib.parse import urlparse, parse_qs
 
 # Configuration
 SCOPES = ['https://www.googleapis.com/auth/photoslibrary.readonly']
-STATE_FILE = 'download_state.json'
+STATE_FILE = 'download_state.json'  # Legacy state, migrated into JOURNAL_FILE
+JOURNAL_FILE = 'download_state.log'
+JOURNAL_FLUSH_EVERY = 64  # Journal records written between fsyncs
+JOURNAL_FLUSH_SECONDS = 5.0  # ...or at most this long between fsyncs
 TOKEN_FILE = 'token.pickle'
 REDIRECT_URI = 'http://localhost'
+API_BASE = 'https://photoslibrary.googleapis.com/v1'  # Pointed elsewhere by fake_photos_api.py
+ALBUM_WORKERS = 8  # Albums paged concurrently while collecting filed IDs
+DOWNLOAD_WORKERS = 4  # Concurrent media downloads feeding the ZIP writer
+MAX_IN_FLIGHT = 8  # Downloaded items allowed to wait for the ZIP writer
+CHUNK_SIZE = 1024 * 1024  # Copy size when streaming response bodies
+SPOOL_LIMIT = 8 * 1024 * 1024  # Larger bodies spill from memory to a temporary file
+HTTP_TIMEOUT = 60  # Socket timeout in seconds for pooled connections
+MAX_IDLE_PER_HOST = 16  # Keep-alive connections kept open per host
+MAX_REDIRECTS = 5
+MAX_RETRIES = 6  # Attempts after the first for throttled or failed requests
+BACKOFF_BASE = 1.0  # Seconds; doubled per retry, with full jitter
+BACKOFF_MAX = 120.0
+# Per endpoint class: steady requests/second, burst size, max concurrency
+ENDPOINT_LIMITS = {
+    'listing': (10.0, 20, 8),
+    'search': (10.0, 20, 16),
+    'media': (50.0, 100, 32),
+}
+CATALOG_FILE = 'catalog.db'
+CONTENT_INDEX_FILE = 'content_index.db'
+FILED_INDEX_FILE = 'filed_index.bin'  # Saved FiledIndex, rebuilt when album membership changes
+FILED_INDEX_CHUNK = 1000000  # IDs hashed and sorted at a time while building it
+FULL_RESCAN_DAYS = 7  # Force a complete library listing at least this often
+BASE_URL_TTL = 50 * 60  # baseUrls expire after ~60 minutes; refresh before that
+BATCH_GET_SIZE = 50  # mediaItems:batchGet accepts at most 50 IDs per call
+LIBRARY_WORKERS = 8  # Date shards listed concurrently (--shard-library)
+SHARD_FIRST_YEAR = 2000  # One shard per year from here on; everything older is one shard
+PARTIAL_DIR = 'partial_downloads'
+RESUME_THRESHOLD = 256 * 1024 * 1024  # Bodies larger than this are checkpointed to disk
+CHECKPOINT_BYTES = 16 * 1024 * 1024  # Progress is made durable this often
+RANGE_SEGMENTS = 1  # Parallel byte ranges per large item
+MIN_SEGMENT_SIZE = 64 * 1024 * 1024
+PIPELINE_BUFFER = 100000  # Listed items held while the album scan finishes (--pipeline)
+VOLUME_WRITERS = 2  # Volumes (or, with --sink dir, files) written at once
+DEFAULT_OUTPUTS = {'zip': 'unfiled_photos.zip', 'dir': 'unfiled_photos', 'tar': '-'}
+VERIFY_WORKERS = 8  # Archive entries (or files) checked in parallel (--verify)
+VERIFY_BATCH = 256  # Entries handed to a verify worker at a time
+VALIDATION_TTL = 24 * 3600  # Reuse a successful token validation for this long
+TOKEN_REFRESH_MARGIN = 5 * 60  # Refresh the access token this long before it expires
+PROGRESS_INTERVAL = 10  # Seconds between progress/ETA lines (and metrics snapshots)
+THROUGHPUT_WINDOW = 60  # Seconds of history the download rate and ETA are based on
+POLL_INTERVAL = 300  # Seconds between polls for changes (--watch)
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+log = logging.getLogger('gphotosdl')
+
+class AuthError(Exception):
+    """The API rejected the saved token; the user has to authenticate again"""
 
 class OAuthHandler(http.server.BaseHTTPRequestHandler):
     """Handler for OAuth callback"""
@@ -40,7 +114,9 @@ class OAuthHandler(http.server.BaseHTTPRequestHandler):
 
 class GoogleAuth:
     """Minimal OAuth 2.0 implementation"""
-    def __init__(self, credentials_file):
+    def __init__(self, credentials_file, token_file=TOKEN_FILE, logger=None):
+        self.token_file = token_file
+        self.log = logger or log
         with open(credentials_file, 'r') as f:
             creds = json.load(f)
             self.client_id = creds['installed']['client_id']
@@ -48,52 +124,57 @@ class GoogleAuth:
             # Extract project_id if available
             self.project_id = creds.get('installed', {}).get('project_id', 'unknown')
 
-        print(f"DEBUG: Loaded credentials")
-        print(f"DEBUG: Client ID: {self.client_id[:20]}...")
-        print(f"DEBUG: Project ID: {self.project_id}")
+        self.log.debug("Loaded credentials")
+        self.log.debug(f"Client ID: {self.client_id[:20]}...")
+        self.log.debug(f"Project ID: {self.project_id}")
 
         self.token = None
         self.refresh_token = None
         self.token_expiry = None
         self.scopes = None
+        self.validation = None
+        self._lock = threading.Lock()
+        self._stop_refresh = threading.Event()
+        self._refresher = None
 
     def authorize(self):
         """Run OAuth flow"""
         # Load saved token if it exists
-        if os.path.exists(TOKEN_FILE):
-            with open(TOKEN_FILE, 'rb') as f:
+        if os.path.exists(self.token_file):
+            with open(self.token_file, 'rb') as f:
                 saved = pickle.load(f)
 
             self.token = saved.get('token')
             self.refresh_token = saved.get('refresh_token')
             self.token_expiry = saved.get('token_expiry')
             self.scopes = saved.get('scopes', [])
+            self.validation = saved.get('validation')
 
             # Check if scopes match what we need
             if set(self.scopes) != set(SCOPES):
-                print("Saved token has different scopes, re-authenticating...")
-                os.remove(TOKEN_FILE)
+                self.log.warning("Saved token has different scopes, re-authenticating...")
+                os.remove(self.token_file)
                 self.token = None
                 self.refresh_token = None
             # Check if token is expired
             elif self.token_expiry and time.time() >= self.token_expiry:
                 if self.refresh_token:
-                    print("Token expired, refreshing...")
+                    self.log.info("Token expired, refreshing...")
                     try:
                         self._refresh_token()
                         return
                     except Exception as e:
-                        print(f"Token refresh failed: {e}, re-authenticating...")
-                        os.remove(TOKEN_FILE)
+                        self.log.warning(f"Token refresh failed: {e}, re-authenticating...")
+                        os.remove(self.token_file)
                         self.token = None
                         self.refresh_token = None
                 else:
-                    print("Token expired and no refresh token, re-authenticating...")
-                    os.remove(TOKEN_FILE)
+                    self.log.warning("Token expired and no refresh token, re-authenticating...")
+                    os.remove(self.token_file)
                     self.token = None
                     self.refresh_token = None
             elif self.token:
-                print("Using saved credentials")
+                self.log.info("Using saved credentials")
                 return
 
         if not self.token:
@@ -121,10 +202,10 @@ class GoogleAuth:
 
         auth_url = 'https://accounts.google.com/o/oauth2/v2/auth?' + urllib.parse.urlencode(auth_params)
 
-        print("Opening browser for authentication...")
-        print(f"DEBUG: Using redirect URI in auth request: {REDIRECT_URI}")
-        print(f"DEBUG: Requesting scopes: {SCOPES}")
-        print(f"DEBUG: Full auth URL: {auth_url}")
+        self.log.info("Opening browser for authentication...")
+        self.log.debug(f"Using redirect URI in auth request: {REDIRECT_URI}")
+        self.log.debug(f"Requesting scopes: {SCOPES}")
+        self.log.debug(f"Full auth URL: {auth_url}")
         webbrowser.open(auth_url)
 
         # Start local server to catch callback
@@ -154,48 +235,42 @@ class GoogleAuth:
         response = urllib.request.urlopen(req)
         token_data = json.loads(response.read().decode('utf-8'))
 
-        print(f"\nDEBUG: Token response received")
-        print(f"DEBUG: Token response keys: {list(token_data.keys())}")
+        self.log.debug("Token response received")
+        self.log.debug(f"Token response keys: {list(token_data.keys())}")
 
         self.token = token_data['access_token']
         self.refresh_token = token_data.get('refresh_token')
         expires_in = token_data.get('expires_in', 3600)
         self.token_expiry = time.time() + expires_in
 
-        print(f"DEBUG: Access token (first 20 chars): {self.token[:20]}")
-        print(f"DEBUG: Has refresh token: {self.refresh_token is not None}")
-        print(f"DEBUG: Expires in: {expires_in} seconds")
+        self.log.debug(f"Has refresh token: {self.refresh_token is not None}")
+        self.log.debug(f"Expires in: {expires_in} seconds")
 
         # Get the scopes that were actually granted
         granted_scopes = token_data.get('scope', '')
         if granted_scopes:
             self.scopes = granted_scopes.split(' ')
-            print(f"DEBUG: Granted scopes from token: {self.scopes}")
+            self.log.debug(f"Granted scopes from token: {self.scopes}")
         else:
             self.scopes = SCOPES
-            print(f"DEBUG: No scope info in token response, assuming: {self.scopes}")
+            self.log.debug(f"No scope info in token response, assuming: {self.scopes}")
 
         # Check if we got the scopes we need
         required_scope = 'https://www.googleapis.com/auth/photoslibrary.readonly'
         if required_scope not in self.scopes:
-            print(f"\n⚠️  WARNING: Required scope not granted!")
-            print(f"   Required: {required_scope}")
-            print(f"   Granted:  {self.scopes}")
-            print(f"\n   This usually means:")
-            print(f"   1. Photos Library API is not enabled in Google Cloud Console")
-            print(f"   2. The scope is not added to the OAuth consent screen")
-            print(f"\n   Please check your Google Cloud Console setup.")
-
-        # Save tokens
-        with open(TOKEN_FILE, 'wb') as f:
-            pickle.dump({
-                'token': self.token,
-                'refresh_token': self.refresh_token,
-                'token_expiry': self.token_expiry,
-                'scopes': self.scopes
-            }, f)
+            self.log.warning("\n⚠️  WARNING: Required scope not granted!")
+            self.log.warning(f"   Required: {required_scope}")
+            self.log.warning(f"   Granted:  {self.scopes}")
+            self.log.warning("\n   This usually means:")
+            self.log.warning("   1. Photos Library API is not enabled in Google Cloud Console")
+            self.log.warning("   2. The scope is not added to the OAuth consent screen")
+            self.log.warning("\n   Please check your Google Cloud Console setup.")
+
+        # Save tokens; a new grant has not been validated yet
+        self.validation = None
+        self._save_token()
 
-        print("Authentication successful!")
+        self.log.info("Authentication successful!")
 
     def _refresh_token(self):
         """Refresh the access token using the refresh token"""
@@ -220,32 +295,1828 @@ class GoogleAuth:
         self.token_expiry = time.time() + expires_in
 
         # Save updated token
-        with open(TOKEN_FILE, 'wb') as f:
+        self._save_token()
+
+        self.log.info("Token refreshed successfully!")
+
+    def _save_token(self):
+        # Write then rename so a reader never sees a half-written pickle
+        tmp_path = self.token_file + '.tmp'
+        with open(tmp_path, 'wb') as f:
             pickle.dump({
                 'token': self.token,
                 'refresh_token': self.refresh_token,
                 'token_expiry': self.token_expiry,
-                'scopes': self.scopes
+                'scopes': self.scopes,
+                'validation': self.validation
             }, f)
+        os.replace(tmp_path, self.token_file)
+
+    def _grant_key(self):
+        """Identify the grant (not the short-lived access token) validated"""
+        grant = self.refresh_token or self.token or ''
+        return hashlib.sha256(f'{self.client_id}:{grant}'.encode('utf-8')).hexdigest()
+
+    def cached_validation(self):
+        """Return the saved validation if it is recent and for this grant"""
+        v = self.validation
+        if v and v.get('grant') == self._grant_key() and time.time() - v.get('at', 0) < VALIDATION_TTL:
+            return v
+        return None
+
+    def record_validation(self, account):
+        """Remember that this grant passed validation, so warm starts skip it"""
+        with self._lock:
+            self.validation = {'grant': self._grant_key(), 'at': time.time(), 'account': account}
+            self._save_token()
+
+    def refresh_now(self, stale_token=None):
+        """Refresh the access token; thread-safe
+
+        If stale_token is given and another thread has already replaced it,
+        nothing is done, so a burst of 401s triggers a single refresh.
+        """
+        with self._lock:
+            if stale_token is not None and self.token != stale_token:
+                return
+            self._refresh_token()
 
-        print("Token refreshed successfully!")
+    def start_auto_refresh(self, margin=TOKEN_REFRESH_MARGIN):
+        """Keep the access token fresh from a background thread
 
-class PhotoDownloader:
+        The token is renewed `margin` seconds before it expires, so long
+        runs never hit a 401 and workers never wait on a refresh.
+        """
+        if self._refresher is not None or not self.refresh_token:
+            return
+        self._stop_refresh.clear()
+        self._refresher = threading.Thread(target=self._auto_refresh, args=(margin,), daemon=True)
+        self._refresher.start()
+
+    def stop_auto_refresh(self):
+        """Stop the background refresh, if running"""
+        self._stop_refresh.set()
+        self._refresher = None
+
+    def _auto_refresh(self, margin):
+        while not self._stop_refresh.is_set():
+            wait = (self.token_expiry or 0) - margin - time.time()
+            if wait > 0:
+                # Re-check at least once a minute in case the expiry moved
+                self._stop_refresh.wait(min(wait, 60))
+                continue
+            try:
+                self.refresh_now()
+            except Exception as e:
+                self.log.warning(f"Background token refresh failed: {e}; retrying in 30 seconds")
+                self._stop_refresh.wait(30)
+
+class PooledResponse:
+    """HTTP response that hands its connection back to the pool when done
+
+    The connection is reused only if the body was read to the end and the
+    server did not ask to close it; anything else closes the socket.
+    """
+    def __init__(self, pool, key, conn, response, url):
+        self._pool = pool
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        data = self._response.read(amt)
+        if data and self._pool.bandwidth:
+            self._pool.bandwidth.acquire(len(data))
+        if self._response.isclosed():
+            self._release()
+        return data
+
+    def close(self):
+        if self._conn is not None:
+            reusable = self._response.isclosed()
+            self._response.close()
+            if not reusable:
+                self._conn.close()
+            self._release()
+
+    def _release(self):
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            self._pool._checkin(self._key, conn, self._response.will_close)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ConnectionPool:
+    """Per-host pool of keep-alive HTTP(S) connections
+
+    Shared by the API client and the media downloader so that repeated
+    requests to photoslibrary.googleapis.com and the media host reuse open
+    TLS connections instead of handshaking every time. Safe to use from
+    several threads; each request holds its connection exclusively until
+    the response has been consumed or closed. With a bandwidth TokenBucket
+    (one token per byte) every body read is charged against it.
+    """
+    def __init__(self, timeout=HTTP_TIMEOUT, max_idle=MAX_IDLE_PER_HOST, bandwidth=None):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.bandwidth = bandwidth
+        self._idle = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def request(self, method, url, body=None, headers=None):
+        """Send a request and return a PooledResponse
+
+        Redirects are followed and HTTP error statuses are raised as
+        urllib.error.HTTPError, matching urllib.request.urlopen.
+        """
+        for _ in range(MAX_REDIRECTS + 1):
+            response = self._send(method, url, body, headers or {})
+            if response.status in (301, 302, 303, 307, 308) and response.headers.get('Location'):
+                response.read()
+                response.close()
+                url = urllib.parse.urljoin(url, response.headers['Location'])
+                if response.status == 303:
+                    method, body = 'GET', None
+                continue
+            if response.status >= 400:
+                error_body = response.read()
+                response.close()
+                raise urllib.error.HTTPError(url, response.status, response.reason,
+                                             response.headers, io.BytesIO(error_body))
+            return response
+        raise urllib.error.URLError(f"too many redirects for {url}")
+
+    def stats(self):
+        """Return {host: {'hits': n, 'misses': n}} (hit = reused connection)"""
+        with self._lock:
+            return {host: dict(counts) for host, counts in self._stats.items()}
+
+    def report(self, logger=log):
+        """Log how many requests per host reused a connection"""
+        stats = self.stats()
+        if stats:
+            logger.info("\nConnection reuse:")
+            for host, counts in sorted(stats.items()):
+                total = counts['hits'] + counts['misses']
+                logger.info(f"  {host}: {counts['hits']}/{total} requests reused a connection, "
+                            f"{counts['misses']} new connections")
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def _send(self, method, url, body, headers):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+
+        conn, reused = self._checkout(key)
+        try:
+            conn.request(method, path, body=body, headers=headers)
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+            conn.close()
+            if not reused:
+                raise
+            # The server dropped an idle keep-alive connection; retry once fresh
+            conn, _ = self._checkout(key, fresh=True)
+            try:
+                conn.request(method, path, body=body, headers=headers)
+                response = conn.getresponse()
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+        return PooledResponse(self, key, conn, response, url)
+
+    def _checkout(self, key, fresh=False):
+        with self._lock:
+            counts = self._stats.setdefault(key[1], {'hits': 0, 'misses': 0})
+            idle = self._idle.get(key)
+            if idle and not fresh:
+                counts['hits'] += 1
+                return idle.pop(), True
+            counts['misses'] += 1
+
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        return conn, False
+
+    def _checkin(self, key, conn, will_close):
+        if will_close or conn.sock is None:
+            conn.close()
+            return
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+
+class TokenBucket:
+    """Classic token bucket: `rate` tokens per second, up to `burst` saved up"""
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Take tokens, waiting until at least one is available
+
+        A request for more than is saved up is granted anyway and leaves
+        the bucket in debt, which later callers wait out.
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if now >= self._paused_until and self._tokens >= 1:
+                    self._tokens -= tokens
+                    return
+                wait = max(self._paused_until - now, (1 - self._tokens) / self.rate)
+            time.sleep(wait)
+
+    def pause(self, seconds):
+        """Hold every caller back for `seconds` (e.g. a Retry-After)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+            self._tokens = 0
+
+
+class AdaptiveLimiter:
+    """Concurrency limit tuned by AIMD
+
+    Each success adds 1/limit to the limit (so +1 per limit's worth of
+    successes); a throttled response halves it, at most once per second
+    so a burst of 429s from the same moment counts as one signal. Other
+    failures leave it as it is.
+    """
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.limit = float(max_limit)
+        self._active = 0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self._active >= int(self.limit):
+                self._cond.wait()
+            self._active += 1
+
+    def release(self, succeeded, throttled=False):
+        with self._cond:
+            self._active -= 1
+            now = time.monotonic()
+            if throttled:
+                if now - self._last_decrease >= 1.0:
+                    self.limit = max(self.min_limit, self.limit / 2)
+                    self._last_decrease = now
+            elif succeeded:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            self._cond.notify_all()
+
+
+class WorkerPool:
+    """Download slots shared fairly between several PhotoDownloaders
+
+    Each downloader runs up to `size` worker threads of its own, but a
+    worker has to hold one of the pool's `size` slots while it fetches an
+    item. Freed slots are granted to the waiting owners in turn, so total
+    concurrency stays at `size` and no profile's backlog can starve the
+    others.
+    """
+    def __init__(self, size=DOWNLOAD_WORKERS):
+        self.size = max(1, size)
+        self._free = self.size
+        self._waiting = {}
+        self._turns = []  # Owners, next in line first
+        self._cond = threading.Condition()
+
+    def acquire(self, owner):
+        with self._cond:
+            self._waiting[owner] = self._waiting.get(owner, 0) + 1
+            if owner not in self._turns:
+                self._turns.append(owner)
+            while not (self._free and self._next() is owner):
+                self._cond.wait()
+            self._free -= 1
+            self._waiting[owner] -= 1
+            # Back of the line until every other waiting owner has had a turn
+            self._turns.remove(owner)
+            self._turns.append(owner)
+            self._cond.notify_all()
+
+    def release(self):
+        with self._cond:
+            self._free += 1
+            self._cond.notify_all()
+
+    def _next(self):
+        return next((owner for owner in self._turns if self._waiting[owner]), None)
+
+
+class RequestScheduler:
+    """Shared rate limiting and retry policy for every outgoing request
+
+    Requests are grouped into endpoint classes (see ENDPOINT_LIMITS), each
+    with its own token bucket and adaptive concurrency limit. 429 and 5xx
+    responses and transient network errors are retried with jittered
+    exponential backoff, honoring Retry-After. On 429 or 503 the class is
+    paused and has its concurrency cut until it recovers; only successful
+    requests let the concurrency grow again.
+    """
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+    THROTTLE_STATUSES = (429, 503)
+
+    def __init__(self, limits=None, max_retries=MAX_RETRIES, metrics=None):
+        self.max_retries = max_retries
+        self.metrics = metrics or Metrics()
+        self.buckets = {}
+        self.limiters = {}
+        for name, (rate, burst, concurrency) in (limits or ENDPOINT_LIMITS).items():
+            self.buckets[name] = TokenBucket(rate, burst)
+            self.limiters[name] = AdaptiveLimiter(concurrency)
+        self.metrics.collect(lambda: [('api_concurrency_limit', {'endpoint': name}, limiter.limit)
+                                      for name, limiter in self.limiters.items()])
+
+    def call(self, endpoint, fn):
+        """Run fn() under endpoint's limits, retrying transient failures
+
+        The concurrency slot covers fn() itself; a response body read after
+        fn() returns (as media downloads do) is not counted against it.
+        """
+        bucket = self.buckets[endpoint]
+        limiter = self.limiters[endpoint]
+        attempt = 0
+        while True:
+            bucket.acquire()
+            limiter.acquire()
+            succeeded = throttled = False
+            started = time.monotonic()
+            try:
+                self._count(endpoint, 'requests')
+                response = fn()
+                succeeded = True
+                return response
+            except urllib.error.HTTPError as e:
+                throttled = e.code in self.THROTTLE_STATUSES
+                if e.code not in self.RETRY_STATUSES or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_after(e.headers) or self._backoff(attempt)
+                if throttled:
+                    self._count(endpoint, 'throttled')
+                    bucket.pause(delay)
+            except (urllib.error.URLError, ConnectionError, socket.timeout, http.client.HTTPException):
+                if attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+            finally:
+                limiter.release(succeeded, throttled)
+                self.metrics.observe('api_request_seconds', time.monotonic() - started, endpoint=endpoint)
+
+            self._count(endpoint, 'retries')
+            attempt += 1
+            time.sleep(delay)
+
+    def stats(self):
+        stats = {}
+        for name, limiter in self.limiters.items():
+            stats[name] = {key: int(self.metrics.value(f'api_{key}_total', endpoint=name))
+                           for key in ('requests', 'retries', 'throttled')}
+            stats[name]['concurrency'] = int(limiter.limit)
+        return stats
+
+    def _count(self, endpoint, key):
+        self.metrics.inc(f'api_{key}_total', endpoint=endpoint)
+
+    @staticmethod
+    def _backoff(attempt):
+        return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2 ** attempt))
+
+    @staticmethod
+    def _retry_after(headers):
+        value = headers.get('Retry-After') if headers else None
+        if not value:
+            return None
+        try:
+            return min(BACKOFF_MAX, max(0.0, float(value)))
+        except ValueError:
+            pass
+        try:
+            when = email.utils.parsedate_to_datetime(value)
+            return min(BACKOFF_MAX, max(0.0, when.timestamp() - time.time()))
+        except (TypeError, ValueError):
+            return None
+
+
+class DownloadJournal:
+    """Append-only record of downloaded media item IDs
+
+    One line per change: '+<id>' when an item is stored, '-<id>' when it
+    is forgotten. Appends are buffered and fsynced in batches, so marking
+    an item costs O(1) instead of rewriting the whole state. A torn last
+    line from a crash is ignored on replay. The file is compacted (rewritten
+    to one '+' line per live ID, then atomically swapped in) when it has
+    grown well past the size of the live set.
+    """
+    def __init__(self, path=JOURNAL_FILE, legacy_path=STATE_FILE,
+                 flush_every=JOURNAL_FLUSH_EVERY, flush_seconds=JOURNAL_FLUSH_SECONDS, logger=None):
+        self.path = path
+        self.log = logger or log
+        self.legacy_path = legacy_path
+        self.flush_every = flush_every
+        self.flush_seconds = flush_seconds
+        self._file = None
+        self._unsynced = 0
+        self._last_sync = time.time()
+        self._records = 0
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Replay the journal and return the set of downloaded IDs"""
+        if not os.path.exists(self.path) and self.legacy_path and os.path.exists(self.legacy_path):
+            return self._migrate()
+
+        ids = set()
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                data = f.read()
+            lines = data.split(b'\n')
+            # Anything after the last newline is a torn write
+            torn = lines.pop() != b''
+            self._records = len(lines)
+            for line in lines:
+                if line[:1] == b'+':
+                    ids.add(line[1:].decode('ascii'))
+                elif line[:1] == b'-':
+                    ids.discard(line[1:].decode('ascii'))
+            if torn or self._records > 2 * len(ids) + 1024:
+                self.compact(ids)
+        return ids
+
+    def add(self, item_id):
+        self._append(b'+' + item_id.encode('ascii'))
+
+    def discard(self, item_id):
+        self._append(b'-' + item_id.encode('ascii'))
+
+    def flush(self):
+        """Write out and fsync buffered records"""
+        with self._lock:
+            self._sync()
+
+    def compact(self, ids):
+        """Rewrite the journal to hold exactly the given IDs"""
+        with self._lock:
+            self._close()
+            tmp_path = self.path + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.writelines(b'+' + item_id.encode('ascii') + b'\n' for item_id in ids)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+            self._records = len(ids)
+
+    def close(self):
+        with self._lock:
+            self._close()
+
+    def _migrate(self):
+        with open(self.legacy_path, 'r') as f:
+            ids = set(json.load(f).get('downloaded', []))
+        self.compact(ids)
+        os.replace(self.legacy_path, self.legacy_path + '.migrated')
+        self.log.info(f"Migrated {len(ids)} entries from {self.legacy_path} to {self.path}")
+        return ids
+
+    def _append(self, record):
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+            self._file.write(record + b'\n')
+            self._records += 1
+            self._unsynced += 1
+            if (self._unsynced >= self.flush_every
+                    or time.time() - self._last_sync >= self.flush_seconds):
+                self._sync()
+
+    def _sync(self):
+        if self._file is not None and self._unsynced:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.time()
+
+    def _close(self):
+        if self._file is not None:
+            self._sync()
+            self._file.close()
+            self._file = None
+
+
+class MediaRecord:
+    """Compact record of one media item: only what the download path needs
+
+    Replaces the raw mediaItem dict (with its full mediaMetadata) so that
+    holding a page or a queue of items costs a few hundred bytes each.
+    """
+    __slots__ = ('id', 'filename', 'mime_type', 'base_url', 'fetched_at',
+                 'creation_time', 'width', 'height')
+
+    def __init__(self, id, filename, mime_type, base_url, fetched_at,
+                 creation_time=None, width=None, height=None):
+        self.id = id
+        self.filename = filename
+        self.mime_type = mime_type
+        self.base_url = base_url
+        self.fetched_at = fetched_at
+        self.creation_time = creation_time
+        self.width = width
+        self.height = height
+
+    @classmethod
+    def from_api(cls, item, fetched_at):
+        metadata = item.get('mediaMetadata', {})
+        return cls(item['id'], item['filename'], item['mimeType'], item['baseUrl'], fetched_at,
+                   metadata.get('creationTime'),
+                   int(metadata['width']) if 'width' in metadata else None,
+                   int(metadata['height']) if 'height' in metadata else None)
+
+    @property
+    def is_video(self):
+        return 'video' in self.mime_type
+
+    @property
+    def download_url(self):
+        # Videos need '=dv' to get the original bytes rather than a still
+        return f"{self.base_url}=dv" if self.is_video else f"{self.base_url}=d"
+
+
+class Catalog:
+    """Local SQLite catalog of albums, album membership and media items
+
+    Lets a rerun skip albums whose mediaItemsCount has not changed since
+    they were last walked, and stop listing the library once it reaches
+    pages it has already seen. Access is serialized with a lock so scan
+    threads can share one connection.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS albums (
+            id TEXT PRIMARY KEY,
+            title TEXT,
+            media_items_count INTEGER,
+            scanned_count INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS album_items (
+            album_id TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            PRIMARY KEY (album_id, item_id)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS album_items_item ON album_items (item_id);
+        CREATE TABLE IF NOT EXISTS items (
+            id TEXT PRIMARY KEY,
+            filename TEXT,
+            mime_type TEXT,
+            creation_time TEXT,
+            base_url TEXT,
+            fetched_at REAL,
+            seen_scan INTEGER,
+            width INTEGER,
+            height INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, path=CATALOG_FILE):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(self.SCHEMA)
+        self._add_missing_columns('items', {'width': 'INTEGER', 'height': 'INTEGER'})
+        self._lock = threading.Lock()
+
+    def _add_missing_columns(self, table, columns):
+        """Upgrade catalogs created before a column was added"""
+        existing = {row[1] for row in self._db.execute(f'PRAGMA table_info({table})')}
+        for name, kind in columns.items():
+            if name not in existing:
+                self._db.execute(f'ALTER TABLE {table} ADD COLUMN {name} {kind}')
+
+    def get_meta(self, key, default=None):
+        with self._lock:
+            row = self._db.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else default
+
+    def set_meta(self, key, value):
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def album_scanned_counts(self):
+        """Return {album_id: mediaItemsCount at the time it was last walked}"""
+        with self._lock:
+            rows = self._db.execute('SELECT id, scanned_count FROM albums WHERE scanned_count IS NOT NULL')
+            return dict(rows.fetchall())
+
+    def iter_album_item_ids(self, batch_size=10000):
+        """Yield the item ID of every album membership (with repeats)"""
+        with self._lock:
+            cursor = self._db.execute('SELECT item_id FROM album_items')
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            for (item_id,) in rows:
+                yield item_id
+
+    def is_filed(self, item_id):
+        """True if the item is in at least one album"""
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM album_items WHERE item_id = ? LIMIT 1',
+                                    (item_id,)).fetchone() is not None
+
+    def membership_version(self):
+        """Token that changes with every change to album_items"""
+        return int(self.get_meta('membership_version', 0))
+
+    def _bump_membership_version(self):
+        # Random rather than counted, so a recreated catalog can never
+        # reuse the version of a stale saved index
+        self._db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('membership_version', ?)",
+                         (str(secrets.randbits(63)),))
+
+    def save_album(self, album, item_ids, left=None):
+        """Replace an album's stored membership with a fresh listing
+
+        With a set for left, IDs that were in the album but no longer are
+        get added to it.
+        """
+        count = int(album.get('mediaItemsCount', 0))
+        with self._lock, self._db:
+            if left is not None:
+                rows = self._db.execute('SELECT item_id FROM album_items WHERE album_id = ?', (album['id'],))
+                left.update({row[0] for row in rows}.difference(item_ids))
+            self._bump_membership_version()
+            self._db.execute('INSERT OR REPLACE INTO albums (id, title, media_items_count, scanned_count) '
+                             'VALUES (?, ?, ?, ?)', (album['id'], album.get('title'), count, count))
+            self._db.execute('DELETE FROM album_items WHERE album_id = ?', (album['id'],))
+            self._db.executemany('INSERT OR IGNORE INTO album_items (album_id, item_id) VALUES (?, ?)',
+                                 ((album['id'], item_id) for item_id in item_ids))
+
+    def prune_albums(self, live_ids, left=None):
+        """Forget albums that no longer exist
+
+        With a set for left, the IDs of their items get added to it.
+        """
+        with self._lock, self._db:
+            stale = [row[0] for row in self._db.execute('SELECT id FROM albums')
+                     if row[0] not in live_ids]
+            for album_id in stale:
+                if left is not None:
+                    rows = self._db.execute('SELECT item_id FROM album_items WHERE album_id = ?', (album_id,))
+                    left.update(row[0] for row in rows)
+                self._db.execute('DELETE FROM albums WHERE id = ?', (album_id,))
+                self._db.execute('DELETE FROM album_items WHERE album_id = ?', (album_id,))
+            if stale:
+                self._bump_membership_version()
+        return len(stale)
+
+    def known_item_ids(self, item_ids):
+        """Return the subset of item_ids already in the catalog"""
+        item_ids = list(item_ids)
+        with self._lock:
+            rows = self._db.execute(
+                f'SELECT id FROM items WHERE id IN ({",".join("?" * len(item_ids))})', item_ids)
+            return {row[0] for row in rows}
+
+    def save_items(self, records, scan_id):
+        with self._lock, self._db:
+            self._db.executemany(
+                'INSERT OR REPLACE INTO items (id, filename, mime_type, creation_time, base_url, fetched_at, '
+                'seen_scan, width, height) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                ((r.id, r.filename, r.mime_type, r.creation_time, r.base_url, r.fetched_at,
+                  scan_id, r.width, r.height) for r in records))
+
+    def update_base_urls(self, records):
+        with self._lock, self._db:
+            self._db.executemany('UPDATE items SET base_url = ?, fetched_at = ? WHERE id = ?',
+                                 ((r.base_url, r.fetched_at, r.id) for r in records))
+
+    def prune_items(self, scan_id):
+        """Forget items not seen by a complete library listing"""
+        with self._lock, self._db:
+            return self._db.execute('DELETE FROM items WHERE seen_scan IS NOT ?', (scan_id,)).rowcount
+
+    def iter_items(self, skip_scan=None, batch_size=1000):
+        """Yield cataloged items as MediaRecords, a batch at a time
+
+        Items seen by scan skip_scan are left out (the caller already has
+        them). Batches are keyed on rowid so the lock is not held between
+        batches and writers are never blocked for long.
+        """
+        last_rowid = 0
+        while True:
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT rowid, id, filename, mime_type, base_url, fetched_at, creation_time, width, height '
+                    'FROM items WHERE rowid > ? AND seen_scan IS NOT ? ORDER BY rowid LIMIT ?',
+                    (last_rowid, skip_scan, batch_size)).fetchall()
+            if not rows:
+                return
+            last_rowid = rows[-1][0]
+            for row in rows:
+                yield MediaRecord(*row[1:])
+
+    def get_items(self, item_ids, batch_size=500):
+        """Yield the cataloged items among item_ids as MediaRecords"""
+        item_ids = list(item_ids)
+        for start in range(0, len(item_ids), batch_size):
+            batch = item_ids[start:start + batch_size]
+            with self._lock:
+                rows = self._db.execute(
+                    'SELECT id, filename, mime_type, base_url, fetched_at, creation_time, width, height '
+                    f'FROM items WHERE id IN ({",".join("?" * len(batch))})', batch).fetchall()
+            for row in rows:
+                yield MediaRecord(*row)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class FiledIndex:
+    """Compact set of the media item IDs that are in at least one album
+
+    A sorted array of 64-bit ID digests; a match is confirmed against the
+    catalog with verify(item_id), so a collision never hides an item.
+    """
+    MAGIC = b'GPFILED1'
+
+    def __init__(self, digests=None, verify=None):
+        self.digests = digests if digests is not None else array('Q')
+        self.verify = verify
+
+    @staticmethod
+    def digest(item_id):
+        return int.from_bytes(hashlib.blake2b(item_id.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    @classmethod
+    def build(cls, item_ids, verify=None, chunk_size=FILED_INDEX_CHUNK):
+        """Build from any iterable of IDs (repeats allowed)
+
+        Digests are sorted chunk_size at a time and the sorted runs merged,
+        so the transient list never holds more than one chunk.
+        """
+        runs, chunk = [], []
+        for item_id in item_ids:
+            chunk.append(cls.digest(item_id))
+            if len(chunk) >= chunk_size:
+                chunk.sort()
+                runs.append(array('Q', chunk))
+                chunk = []
+        if chunk:
+            chunk.sort()
+            runs.append(array('Q', chunk))
+
+        digests = array('Q')
+        last = None
+        for value in heapq.merge(*runs):
+            if value != last:
+                digests.append(value)
+                last = value
+        return cls(digests, verify)
+
+    @classmethod
+    def load(cls, path, version, verify=None):
+        """Return the index saved at path for this version, or None"""
+        try:
+            with open(path, 'rb') as f:
+                header = f.read(24)
+                if len(header) != 24 or header[:8] != cls.MAGIC:
+                    return None
+                if int.from_bytes(header[8:16], 'little') != version:
+                    return None
+                count = int.from_bytes(header[16:24], 'little')
+                digests = array('Q')
+                digests.fromfile(f, count)
+        except (OSError, EOFError):
+            return None
+        if sys.byteorder != 'little':
+            digests.byteswap()
+        return cls(digests, verify)
+
+    def save(self, path, version):
+        digests = self.digests
+        if sys.byteorder != 'little':
+            digests = array('Q', digests)
+            digests.byteswap()
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(self.MAGIC + version.to_bytes(8, 'little') + len(digests).to_bytes(8, 'little'))
+            digests.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def __contains__(self, item_id):
+        value = self.digest(item_id)
+        i = bisect.bisect_left(self.digests, value)
+        if i == len(self.digests) or self.digests[i] != value:
+            return False
+        return self.verify is None or self.verify(item_id)
+
+    def __len__(self):
+        return len(self.digests)
+
+
+class RestartDownload(Exception):
+    """The server no longer matches a checkpoint; start the item over"""
+
+
+class ResumableDownload:
+    """Large media download checkpointed to disk for byte-range resume
+
+    Data is fsynced before its JSON sidecar records it. Once complete the
+    object reads back like a response; remove() deletes the files.
+    """
+    def __init__(self, item, directory=PARTIAL_DIR, logger=None):
+        key = hashlib.sha1(item.id.encode('utf-8')).hexdigest()
+        self.item = item
+        self.log = logger or log
+        self.part_path = os.path.join(directory, key + '.part')
+        self.meta_path = os.path.join(directory, key + '.json')
+        self.meta = None
+        self.headers = {}
+        self._file = None
+        self._lock = threading.Lock()
+        self._unsynced = 0
+        if os.path.exists(self.meta_path) and os.path.exists(self.part_path):
+            with open(self.meta_path, 'r') as f:
+                self.meta = json.load(f)
+
+    @property
+    def checkpointed(self):
+        return self.meta is not None
+
+    @property
+    def received(self):
+        return sum(done for _, _, done in self.meta['segments']) if self.meta else 0
+
+    def fetch(self, open_range, first_response=None, segments=1):
+        """Download whatever is missing
+
+        open_range(headers) must return a response for the item's URL with
+        the extra request headers applied. first_response, if given, is a
+        fresh full-body response to start from instead of a checkpoint.
+        """
+        if first_response is not None:
+            self._start(first_response, segments)
+        try:
+            self._fetch_missing(open_range, first_response)
+        except RestartDownload:
+            self.log.info(f"{self.item.filename} changed on the server, restarting it")
+            self.remove()
+            response = open_range({})
+            self._start(response, segments)
+            self._fetch_missing(open_range, response)
+
+        size = self.meta['size']
+        if os.path.getsize(self.part_path) != size or self.received != size:
+            raise IOError(f"incomplete download: got {self.received} of {size} bytes")
+        self.headers = {'Content-Length': str(size)}
+        self._file = open(self.part_path, 'rb')
+
+    def _start(self, response, segments):
+        size = int(response.headers['Content-Length'])
+        ranged = response.headers.get('Accept-Ranges', '').lower() == 'bytes'
+        segments = max(1, min(segments, size // MIN_SEGMENT_SIZE)) if ranged else 1
+        step = max(1, -(-size // segments))
+        self.meta = {
+            'item_id': self.item.id,
+            'size': size,
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'segments': [[start, min(start + step, size), 0] for start in range(0, size, step)] or [[0, 0, 0]],
+        }
+        os.makedirs(os.path.dirname(self.part_path) or '.', exist_ok=True)
+        with open(self.part_path, 'wb') as f:
+            f.truncate(size)
+        self._save_meta()
+
+    def _fetch_missing(self, open_range, first_response):
+        todo = [i for i, (start, end, done) in enumerate(self.meta['segments']) if start + done < end]
+        if first_response is not None:
+            if len(self.meta['segments']) == 1:
+                # Single range from zero: keep reading the response we have
+                self._run_segments([(0, first_response)])
+                return
+            first_response.close()
+        self._run_segments([(i, None) for i in todo], open_range)
+
+    def _run_segments(self, jobs, open_range=None):
+        errors = []
+
+        def run(index, response):
+            try:
+                self._fetch_segment(index, response, open_range)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=run, args=job, daemon=True) for job in jobs[1:]]
+        for t in threads:
+            t.start()
+        if jobs:
+            run(*jobs[0])
+        for t in threads:
+            t.join()
+        with self._lock:
+            self._save_meta()
+        if errors:
+            raise errors[0]
+
+    def _fetch_segment(self, index, response, open_range):
+        segment = self.meta['segments'][index]
+        start, end, done = segment
+        if response is None:
+            headers = {'Range': f'bytes={start + done}-{end - 1}'}
+            validator = self.meta.get('etag') or self.meta.get('last_modified')
+            if validator:
+                headers['If-Range'] = validator
+            try:
+                response = open_range(headers)
+            except urllib.error.HTTPError as e:
+                if e.code == 416:
+                    raise RestartDownload()
+                raise
+            if response.status != 206:
+                response.close()
+                raise RestartDownload()
+
+        with response, open(self.part_path, 'r+b') as f:
+            f.seek(start + done)
+            while start + segment[2] < end:
+                chunk = response.read(min(CHUNK_SIZE, end - start - segment[2]))
+                if not chunk:
+                    raise IOError(f"connection closed after {self.received} of {self.meta['size']} bytes")
+                f.write(chunk)
+                with self._lock:
+                    segment[2] += len(chunk)
+                    self._unsynced += len(chunk)
+                    if self._unsynced >= CHECKPOINT_BYTES:
+                        f.flush()
+                        os.fsync(f.fileno())
+                        self._save_meta()
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _save_meta(self):
+        # Callers fsync their data first, so the sidecar never runs ahead of it.
+        # Other segments' counts may include unsynced bytes; that only costs
+        # a re-fetch of those bytes if the part file itself was lost.
+        tmp_path = self.meta_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, self.meta_path)
+        self._unsynced = 0
+
+    def read(self, amt=None):
+        return self._file.read(amt)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def remove(self):
+        """Delete the part file and its checkpoint"""
+        self.close()
+        for path in (self.part_path, self.meta_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.meta = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SpooledBody:
+    """Downloaded body held in memory up to SPOOL_LIMIT, the rest in a temp file
+
+    The download worker reads the whole response into it, so the writer
+    that later streams it into the archive only copies local bytes.
+    """
+    def __init__(self, head, response):
+        self._file = tempfile.SpooledTemporaryFile(max_size=SPOOL_LIMIT)
+        try:
+            for chunk in _read_body(head, response):
+                self._file.write(chunk)
+        except Exception:
+            self._file.close()
+            raise
+        self.headers = {'Content-Length': str(self._file.tell())}
+        self._file.seek(0)
+
+    def read(self, amt=None):
+        return self._file.read(amt)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class ContentIndex:
+    """Persistent index of what has been stored in which archive
+
+    Maps each stored body's SHA-256 and size to the archive and entry that
+    hold it, and each media item to the entry it was stored as (or refers
+    to). Used to give same-named files distinct, deterministic entry names
+    and to store byte-identical content only once, across runs and across
+    archives.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS content (
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            archive TEXT NOT NULL,
+            name TEXT NOT NULL,
+            PRIMARY KEY (hash, size)
+        );
+        CREATE TABLE IF NOT EXISTS names (
+            archive TEXT NOT NULL,
+            name TEXT NOT NULL,
+            item_id TEXT NOT NULL,
+            PRIMARY KEY (archive, name)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS items (
+            item_id TEXT PRIMARY KEY,
+            hash TEXT NOT NULL,
+            size INTEGER NOT NULL,
+            archive TEXT NOT NULL,
+            name TEXT NOT NULL,
+            duplicate INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS volumes (
+            archive TEXT PRIMARY KEY,
+            base TEXT NOT NULL,
+            number INTEGER NOT NULL,
+            full INTEGER NOT NULL DEFAULT 0,
+            entries INTEGER NOT NULL DEFAULT 0,
+            size INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS content_entry ON content (archive, name);
+        CREATE INDEX IF NOT EXISTS items_entry ON items (archive, name);
+    """
+
+    def __init__(self, path=CONTENT_INDEX_FILE):
+        self.path = path
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.executescript(self.SCHEMA)
+        self._lock = threading.Lock()
+        self._claimed = set()
+
+    def entry_name(self, archive, filename, item_id, taken=()):
+        """Pick the entry name for an item, unique within the archive
+
+        `taken` holds names already in the archive but possibly unknown to
+        the index (e.g. older archives).
+        """
+        stem, ext = os.path.splitext(filename)
+        suffix = hashlib.sha1(item_id.encode('utf-8')).hexdigest()
+        candidates = [filename] + [f"{stem}~{suffix[:n]}{ext}" for n in (8, 16, 40)]
+        with self._lock:
+            for name in candidates:
+                row = self._db.execute('SELECT item_id FROM names WHERE archive = ? AND name = ?',
+                                       (archive, name)).fetchone()
+                if (row is None and name not in taken) or (row and row[0] == item_id):
+                    return name
+        raise IOError(f"no unique entry name left for {filename}")
+
+    def find(self, digest, size):
+        """Return (archive, name) already holding this content, or None"""
+        with self._lock:
+            return self._db.execute('SELECT archive, name FROM content WHERE hash = ? AND size = ?',
+                                    (digest, size)).fetchone()
+
+    def record(self, item_id, digest, size, archive, name, duplicate=False):
+        """Record where an item's content lives
+
+        For a stored body, (archive, name) is its new entry; for a
+        duplicate it is the entry that already holds the same bytes.
+        """
+        with self._lock, self._db:
+            if not duplicate:
+                self._db.execute('INSERT OR IGNORE INTO content (hash, size, archive, name) VALUES (?, ?, ?, ?)',
+                                 (digest, size, archive, name))
+                self._db.execute('INSERT OR REPLACE INTO names (archive, name, item_id) VALUES (?, ?, ?)',
+                                 (archive, name, item_id))
+            self._db.execute('INSERT OR REPLACE INTO items (item_id, hash, size, archive, name, duplicate) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', (item_id, digest, size, archive, name, int(duplicate)))
+
+    def archives(self):
+        """Every archive (or directory tree) that items are recorded in"""
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT DISTINCT archive FROM items')]
+
+    def stored_entries(self, archive):
+        """Return {name: (sha256 hex, size)} for the bodies stored in archive"""
+        with self._lock:
+            rows = self._db.execute('SELECT name, hash, size FROM content WHERE archive = ?', (archive,))
+            return {name: (digest, size) for name, digest, size in rows}
+
+    def item_ids(self, archive=None):
+        """IDs of items recorded in archive, or in any archive"""
+        with self._lock:
+            if archive is None:
+                rows = self._db.execute('SELECT item_id FROM items').fetchall()
+            else:
+                rows = self._db.execute('SELECT item_id FROM items WHERE archive = ?', (archive,)).fetchall()
+        return [row[0] for row in rows]
+
+    def forget_entries(self, archive, names):
+        """Drop entries that are gone or damaged, and every item stored as them
+
+        Returns the number of items forgotten.
+        """
+        forgotten = 0
+        with self._lock, self._db:
+            for name in names:
+                self._db.execute('DELETE FROM content WHERE archive = ? AND name = ?', (archive, name))
+                self._db.execute('DELETE FROM names WHERE archive = ? AND name = ?', (archive, name))
+                forgotten += self._db.execute('DELETE FROM items WHERE archive = ? AND name = ?',
+                                              (archive, name)).rowcount
+        return forgotten
+
+    def claim_volume(self, base, path_for):
+        """Return a volume of `base` for one writer to fill
+
+        Reuses the lowest-numbered volume that is neither full nor held
+        by another writer, otherwise registers the next number, named by
+        path_for(number). Full volumes are never handed out again, so a
+        restart only ever reopens volumes that still have room.
+        """
+        with self._lock, self._db:
+            for (archive,) in self._db.execute('SELECT archive FROM volumes WHERE base = ? AND full = 0 '
+                                               'ORDER BY number', (base,)).fetchall():
+                if archive not in self._claimed:
+                    self._claimed.add(archive)
+                    return archive
+            row = self._db.execute('SELECT MAX(number) FROM volumes WHERE base = ?', (base,)).fetchone()
+            number = (row[0] or 0) + 1
+            archive = path_for(number)
+            self._db.execute('INSERT INTO volumes (archive, base, number) VALUES (?, ?, ?)',
+                             (archive, base, number))
+            self._claimed.add(archive)
+            return archive
+
+    def release_volume(self, archive, full, entries, size):
+        with self._lock, self._db:
+            self._db.execute('UPDATE volumes SET full = ?, entries = ?, size = ? WHERE archive = ?',
+                             (int(full), entries, size, archive))
+            self._claimed.discard(archive)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ZipSink:
+    """Writes items into a ZIP archive, or a numbered series of volumes
+
+    With no limits this is the single output archive. With max_size
+    (bytes) and/or max_items it is a numbered series of volumes next to
+    it, e.g. unfiled_photos.001.zip, unfiled_photos.002.zip; each of up to
+    `writers` threads fills its own volume and rolls over to a fresh one
+    when the current one reaches a limit. The content index records which
+    volume holds each item and which volumes are full.
+    """
+    def __init__(self, path, index, max_size=None, max_items=None, writers=VOLUME_WRITERS, logger=None):
+        self.path = path
+        self.log = logger or log
+        self.index = index
+        self.max_size = max_size
+        self.max_items = max_items
+        self.writers = max(1, writers) if self.multi else 1
+
+    @property
+    def multi(self):
+        return bool(self.max_size or self.max_items)
+
+    def open(self):
+        """Return a ZipVolume for one writer"""
+        if not self.multi:
+            return ZipVolume(self, self.path)
+        archive = self.index.claim_volume(self.path, self._volume_path)
+        self.log.info(f"Writing to volume {archive}")
+        return ZipVolume(self, archive)
+
+    def _volume_path(self, number):
+        stem, ext = os.path.splitext(self.path)
+        return f"{stem}.{number:03d}{ext or '.zip'}"
+
+
+class ZipVolume:
+    """One open archive of a ZipSink, owned by a single writer thread"""
+    def __init__(self, sink, archive):
+        self.sink = sink
+        self.archive = archive
+        if os.path.exists(archive) and os.path.getsize(archive):
+            # After a crash while appending, 'a' would start a new archive
+            # whose directory lists none of the entries already stored
+            entries, end, recovered = _zip_entries(archive)
+            if recovered:
+                _rewrite_central_directory(archive, entries, end)
+                sink.log.warning(f"{archive}: central directory was lost, rebuilt from {len(entries)} entries; "
+                                 "run with --verify to check them")
+        self.zipf = ZipFile(archive, 'a')
+
+    def __contains__(self, name):
+        return name in self.zipf.NameToInfo
+
+    def claim_name(self, index, item):
+        return index.entry_name(self.archive, item.filename, item.id, self)
+
+    def full(self):
+        sink = self.sink
+        return bool((sink.max_size and self.zipf.start_dir >= sink.max_size)
+                    or (sink.max_items and len(self.zipf.filelist) >= sink.max_items))
+
+    def add(self, name, item, head, response, find):
+        """Write a downloaded body into a new ZIP entry
+
+        Returns (sha256 hex, size, existing). The hash is computed as the
+        body streams through; if find(hash, size) reports identical bytes
+        already stored, existing is their (archive, name) and nothing is
+        kept in this archive. A body that fails part way through, or turns
+        out to be a duplicate only once streamed, is rolled back out of the
+        archive, so neither leaves an entry behind.
+        """
+        zipf = self.zipf
+        if response is None:
+            digest = hashlib.sha256(head).hexdigest()
+            existing = find(digest, len(head))
+            if not existing:
+                zipf.writestr(name, head)
+            return digest, len(head), existing
+
+        zinfo = ZipInfo(name, time.localtime()[:6])
+        zinfo.compress_type = zipf.compression
+        previous = zipf.NameToInfo.get(name)
+        digest = hashlib.sha256()
+        try:
+            with zipf.open(zinfo, 'w', force_zip64=True) as entry:
+                for chunk in _read_body(head, response):
+                    digest.update(chunk)
+                    entry.write(chunk)
+        except Exception:
+            _discard_entry(zipf, zinfo, previous)
+            raise
+
+        existing = find(digest.hexdigest(), zinfo.file_size)
+        if existing:
+            _discard_entry(zipf, zinfo, previous)
+        return digest.hexdigest(), zinfo.file_size, existing
+
+    def close(self):
+        sink = self.sink
+        full = sink.multi and self.full()
+        entries, size = len(self.zipf.filelist), self.zipf.start_dir
+        self.zipf.close()
+        if sink.multi:
+            sink.index.release_volume(self.archive, full, entries, size)
+
+
+class DirectorySink:
+    """Writes items as files under root/<year>/<month>/ by creation time
+
+    Any number of writer threads can add files at once. Each body is
+    written to a hidden temporary file in its final directory, fsynced and
+    renamed into place, so a file only ever appears under its real name
+    complete. Modification times are set to the item's creation time.
+    """
+    def __init__(self, root, writers=VOLUME_WRITERS):
+        self.root = root
+        self.archive = root
+        self.writers = max(1, writers)
+        self._lock = threading.Lock()
+        self._pending = set()
+        os.makedirs(root, exist_ok=True)
+
+    def open(self):
+        # Writers share the tree; naming is serialized by claim_name
+        return self
+
+    def full(self):
+        return False
+
+    def close(self):
+        pass
+
+    def __contains__(self, name):
+        return name in self._pending or os.path.lexists(os.path.join(self.root, name))
+
+    def claim_name(self, index, item):
+        created = _creation_time(item)
+        folder = f"{created.year:04d}/{created.month:02d}" if created else 'undated'
+        with self._lock:
+            name = index.entry_name(self.archive, f"{folder}/{item.filename}", item.id, self)
+            # Held until the file is in place, so no other writer picks it
+            self._pending.add(name)
+        return name
+
+    def add(self, name, item, head, response, find):
+        """Write a downloaded body to its file; see ZipVolume.add"""
+        path = os.path.join(self.root, *name.split('/'))
+        try:
+            if response is None:
+                digest = hashlib.sha256(head).hexdigest()
+                existing = find(digest, len(head))
+                if existing:
+                    return digest, len(head), existing
+
+            directory = os.path.dirname(path)
+            os.makedirs(directory, exist_ok=True)
+            fd, temp = tempfile.mkstemp(prefix='.', suffix='.part', dir=directory)
+            try:
+                digest, size = hashlib.sha256(), 0
+                with os.fdopen(fd, 'wb') as f:
+                    for chunk in _read_body(head, response):
+                        digest.update(chunk)
+                        f.write(chunk)
+                        size += len(chunk)
+                    f.flush()
+                    os.fsync(f.fileno())
+                existing = find(digest.hexdigest(), size)
+                if existing:
+                    os.remove(temp)
+                else:
+                    os.replace(temp, path)
+            except Exception:
+                if os.path.exists(temp):
+                    os.remove(temp)
+                raise
+        finally:
+            with self._lock:
+                self._pending.discard(name)
+
+        created = _creation_time(item)
+        if created and not existing:
+            os.utime(path, (created.timestamp(), created.timestamp()))
+        return digest.hexdigest(), size, existing
+
+
+class TarStreamSink:
+    """Writes items as a tar stream, e.g. to stdout for a backup pipe
+
+    A stream cannot be rewound to drop a failed or duplicate entry, so
+    each body is first spooled (in memory up to SPOOL_LIMIT, then to a
+    temporary file) and hashed, and only written out once it is known to
+    be complete and new. Single writer; a rerun streams only the items
+    not downloaded before.
+    """
+    writers = 1
+
+    def __init__(self, stream, archive='<stdout>', close_stream=False):
+        self.stream = stream
+        self.archive = archive
+        self.close_stream = close_stream
+        self._tar = tarfile.open(fileobj=stream, mode='w|', format=tarfile.PAX_FORMAT)
+        self._names = set()
+
+    def open(self):
+        return self
+
+    def full(self):
+        return False
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def claim_name(self, index, item):
+        return index.entry_name(self.archive, item.filename, item.id, self)
+
+    def add(self, name, item, head, response, find):
+        """Append a downloaded body to the stream; see ZipVolume.add"""
+        digest, size = hashlib.sha256(), 0
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_LIMIT) as spool:
+            for chunk in _read_body(head, response):
+                digest.update(chunk)
+                spool.write(chunk)
+                size += len(chunk)
+            existing = find(digest.hexdigest(), size)
+            if not existing:
+                created = _creation_time(item)
+                info = tarfile.TarInfo(name)
+                info.size = size
+                info.mode = 0o644
+                info.mtime = created.timestamp() if created else time.time()
+                spool.seek(0)
+                self._tar.addfile(info, spool)
+                self._names.add(name)
+        return digest.hexdigest(), size, existing
+
+    def close(self):
+        self._tar.close()
+        if self.close_stream:
+            self.stream.close()
+        else:
+            self.stream.flush()
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms for one run
+
+    Series are keyed by name plus keyword labels. Gauges can also come
+    from collectors, callables polled at snapshot time that return
+    (name, labels, value) triples, for things like queue depths that are
+    cheaper to read than to track. snapshot() returns everything as a
+    JSON-ready dict and prometheus() in the Prometheus text format.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.started = time.time()
+        self._counters = {}
+        self._gauges = {}
+        self._histograms = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self._lock:
+            self._gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            counts = self._histograms.get(key)
+            if counts is None:
+                # One count per bucket plus +Inf, then the sum
+                counts = self._histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def value(self, name, **labels):
+        """Current value of a counter or gauge (0 if never set)"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def collect(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def discard(self, collector):
+        with self._lock:
+            self._collectors.remove(collector)
+
+    def snapshot(self):
+        """Return {'time', 'uptime_seconds', 'counters', 'gauges', 'histograms'}
+
+        Each section maps a metric name to a list of {'labels', ...}
+        series; histogram series carry count, sum and cumulative bucket
+        counts keyed by upper bound.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            gauges = dict(self._gauges)
+            histograms = {key: list(counts) for key, counts in self._histograms.items()}
+            collectors = list(self._collectors)
+        for collector in collectors:
+            for name, labels, value in collector():
+                gauges[(name, tuple(sorted(labels.items())))] = value
+
+        def group(series, render):
+            out = {}
+            for (name, labels), value in sorted(series.items()):
+                out.setdefault(name, []).append(dict(render(value), labels=dict(labels)))
+            return out
+
+        def histogram(counts):
+            cumulative, running = {}, 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                running += count
+                cumulative[str(bound)] = running
+            return {'count': running, 'sum': round(counts[-1], 6), 'buckets': cumulative}
+
+        now = time.time()
+        return {
+            'time': now,
+            'uptime_seconds': round(now - self.started, 3),
+            'counters': group(counters, lambda value: {'value': value}),
+            'gauges': group(gauges, lambda value: {'value': value}),
+            'histograms': group(histograms, histogram),
+        }
+
+    def prometheus(self, prefix='gphotosdl_'):
+        """Render a snapshot in the Prometheus text exposition format"""
+        snapshot = self.snapshot()
+        lines = []
+
+        def series(name, labels, value, **extra):
+            labels = dict(labels, **extra)
+            rendered = ','.join(f'{k}="{v}"' for k, v in labels.items())
+            lines.append(f"{prefix}{name}{{{rendered}}} {value}" if rendered else f"{prefix}{name} {value}")
+
+        for kind in ('counters', 'gauges'):
+            for name, entries in snapshot[kind].items():
+                lines.append(f"# TYPE {prefix}{name} {'counter' if kind == 'counters' else 'gauge'}")
+                for entry in entries:
+                    series(name, entry['labels'], entry['value'])
+        for name, entries in snapshot['histograms'].items():
+            lines.append(f"# TYPE {prefix}{name} histogram")
+            for entry in entries:
+                for bound, count in entry['buckets'].items():
+                    series(f"{name}_bucket", entry['labels'], count, le=bound)
+                series(f"{name}_sum", entry['labels'], entry['sum'])
+                series(f"{name}_count", entry['labels'], entry['count'])
+        series('uptime_seconds', {}, snapshot['uptime_seconds'])
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /metrics (Prometheus text) and /metrics.json for a Metrics
+
+    With a status callable it also serves its result as /status.
+    """
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            body = self.server.metrics.prometheus().encode('utf-8')
+            content_type = 'text/plain; version=0.0.4'
+        elif path == '/metrics.json':
+            body = json.dumps(self.server.metrics.snapshot()).encode('utf-8')
+            content_type = 'application/json'
+        elif path == '/status' and self.server.status:
+            body = json.dumps(self.server.status()).encode('utf-8')
+            content_type = 'application/json'
+        else:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve_metrics(metrics, port, host='127.0.0.1', status=None, logger=log):
+    """Serve metrics (and status) over HTTP on a daemon thread; returns the server"""
+    server = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    server.status = status
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    logger.info(f"Serving metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+class ProgressReporter:
+    """Logs download progress with a throughput-based ETA
+
+    Every interval seconds it logs one line with items and bytes stored,
+    the recent download rate and, from that rate and the number of items
+    still queued, an estimated time to completion; the rate and ETA are
+    published as gauges too. With snapshot_path it also rewrites that file
+    with a JSON metrics snapshot each time (and once more on stop).
+    """
+    def __init__(self, metrics, interval=PROGRESS_INTERVAL, snapshot_path=None, logger=None):
+        self.metrics = metrics
+        self.log = logger or log
+        self.interval = interval
+        self.snapshot_path = snapshot_path
+        self._history = []
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        self.write_snapshot()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.report()
+            self.write_snapshot()
+
+    def report(self):
+        metrics = self.metrics
+        if not metrics.value('downloading'):
+            return
+        now = time.monotonic()
+        items = metrics.value('downloaded_items_total')
+        stored = metrics.value('downloaded_bytes_total')
+        self._history.append((now, items, stored))
+        while len(self._history) > 2 and now - self._history[0][0] > THROUGHPUT_WINDOW:
+            self._history.pop(0)
+
+        then, items_then, bytes_then = self._history[0]
+        elapsed = now - then
+        item_rate = (items - items_then) / elapsed if elapsed else 0.0
+        byte_rate = (stored - bytes_then) / elapsed if elapsed else 0.0
+        metrics.set('download_items_per_second', round(item_rate, 3))
+        metrics.set('download_bytes_per_second', round(byte_rate, 1))
+
+        queued = metrics.value('download_items_queued_total')
+        failed = metrics.value('download_errors_total')
+        remaining = max(0, queued - items - failed)
+        listing = '' if metrics.value('listing_complete') else '+'
+        if item_rate > 0:
+            eta = remaining / item_rate
+            metrics.set('download_eta_seconds', round(eta, 1))
+            eta_text = f"ETA {_format_duration(eta)}{' for the items listed so far' if listing else ''}"
+        else:
+            eta_text = 'ETA unknown'
+        self.log.info(f"Downloaded {int(items)} of {int(queued)}{listing} items ({stored / 1024 ** 2:.1f} MB), "
+                      f"{item_rate:.1f} items/s, {byte_rate / 1024 ** 2:.1f} MB/s, {eta_text}")
+
+    def write_snapshot(self):
+        if not self.snapshot_path:
+            return
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.metrics.snapshot(), f, indent=1)
+        os.replace(tmp_path, self.snapshot_path)
+
+
+class PhaseTimer:
+    """Records when each phase of a run started and finished"""
     def __init__(self):
-        self.auth = GoogleAuth('credentials.json')
-        self.filed_ids = set()
-        self.all_items = []
+        self.phases = {}
+        self._lock = threading.Lock()
+
+    def start(self, name):
+        with self._lock:
+            self.phases[name] = [time.time(), None]
+
+    def stop(self, name):
+        with self._lock:
+            if name in self.phases:
+                self.phases[name][1] = time.time()
+
+    def collect(self):
+        """Phase durations so far, as a Metrics collector"""
+        now = time.time()
+        with self._lock:
+            return [('phase_seconds', {'phase': name}, round((end or now) - start, 3))
+                    for name, (start, end) in self.phases.items()]
+
+    def report(self, logger=log):
+        """Log each phase's duration and how much of it overlapped others"""
+        with self._lock:
+            phases = [(name, start, end or time.time()) for name, (start, end) in self.phases.items()]
+        if not phases:
+            return
+        phases.sort(key=lambda phase: phase[1])
+        first = phases[0][1]
+        wall = max(end for _, _, end in phases) - first
+        busy = sum(end - start for _, start, end in phases)
+
+        logger.info("\nPhase timings:")
+        for name, start, end in phases:
+            logger.info(f"  {name:<14} {end - start:8.1f}s  (+{start - first:.1f}s to +{end - first:.1f}s)")
+        logger.info(f"  {'wall clock':<14} {wall:8.1f}s  (phases total {busy:.1f}s, "
+                    f"{max(busy - wall, 0):.1f}s overlapped)")
+
+
+class ProfileLogger(logging.LoggerAdapter):
+    """Prefixes each message with a profile name, after any leading newlines"""
+    def __init__(self, logger, profile):
+        super().__init__(logger, {'profile': profile})
+
+    def process(self, msg, kwargs):
+        text = str(msg)
+        body = text.lstrip('\n')
+        return f"{text[:len(text) - len(body)]}[{self.extra['profile']}] {body}", kwargs
+
+
+class PhotoDownloader:
+    def __init__(self, album_workers=ALBUM_WORKERS, download_workers=DOWNLOAD_WORKERS,
+                 max_in_flight=MAX_IN_FLIGHT, full_rescan=False, pipeline_buffer=PIPELINE_BUFFER,
+                 range_segments=RANGE_SEGMENTS, shard_library=False, library_workers=LIBRARY_WORKERS,
+                 since_last_run=False, volume_size=None, volume_items=None,
+                 volume_writers=VOLUME_WRITERS, sink='zip', auth=None, metrics_file=None,
+                 progress_interval=PROGRESS_INTERVAL, home=None, name=None, pool=None,
+                 worker_pool=None):
+        # home is the profile directory holding credentials, token, state,
+        # catalog and indexes (default: the current directory); pool and
+        # worker_pool can be shared with other profiles' downloaders
+        self.home = home
+        self.name = name
+        self.log = ProfileLogger(log, name) if name else log
+        # auth defaults to the interactive OAuth flow; anything with a
+        # .token attribute (and .refresh_token = None) works for testing
+        self.auth = auth or GoogleAuth(self.path('credentials.json'), self.path(TOKEN_FILE), self.log)
+        self.pool = pool or ConnectionPool()
+        self._owns_pool = pool is None
+        self.metrics = Metrics()
+        self.scheduler = RequestScheduler(metrics=self.metrics)
+        self.album_workers = max(1, album_workers)
+        self.worker_pool = worker_pool or WorkerPool(download_workers)
+        self.download_workers = self.worker_pool.size
+        self.max_in_flight = max(1, max_in_flight)
+        self.full_rescan = full_rescan
+        self.pipeline_buffer = max(1, pipeline_buffer)
+        self.range_segments = max(1, range_segments)
+        self.shard_library = shard_library
+        self.library_workers = max(1, library_workers)
+        self.since_last_run = since_last_run
+        self.volume_size = volume_size
+        self.volume_items = volume_items
+        self.volume_writers = max(1, volume_writers)
+        self.sink = sink
+        self.phases = PhaseTimer()
+        self.metrics.collect(self.phases.collect)
+        self.progress = ProgressReporter(self.metrics, progress_interval,
+                                         metrics_file and self.path(metrics_file), self.log)
+        self.url_refreshes = 0
+        self._refresh_lock = threading.Lock()
+        self.catalog = Catalog(self.path(CATALOG_FILE))
+        self.index = ContentIndex(self.path(CONTENT_INDEX_FILE))
+        self.filed_ids = FiledIndex()
+        self.dropped_from_albums = set()
         self.downloaded = set()
+        self.journal = DownloadJournal(self.path(JOURNAL_FILE), self.path(STATE_FILE), logger=self.log)
+        self.watch_status = {'state': 'starting', 'polls': 0}
+        self._stop_watching = threading.Event()
         self.load_state()
 
+    def path(self, name):
+        """Path of a per-profile file"""
+        return os.path.join(self.home, name) if self.home else name
+
     def authenticate(self):
         self.auth.authorize()
-        # Validate the token after authentication
-        self._validate_token()
+        # Validate the token after authentication, unless this grant
+        # already passed recently
+        cached = self.auth.cached_validation()
+        if cached:
+            self.log.info(f"Using cached token validation for {cached.get('account') or 'unknown account'}")
+        else:
+            self._validate_token()
+        self.auth.start_auto_refresh()
 
     def _validate_token(self):
         """Validate the access token by checking with Google's token info endpoint"""
-        print("\nValidating access token...")
+        self.log.info("\nValidating access token...")
         try:
             # Use Google's tokeninfo endpoint to verify the token
             token_info_url = f'https://oauth2.googleapis.com/tokeninfo?access_token={self.auth.token}'
@@ -253,154 +2124,232 @@ class PhotoDownloader:
             response = urllib.request.urlopen(req)
             token_info = json.loads(response.read().decode('utf-8'))
 
-            print(f"DEBUG: Token info response: {json.dumps(token_info, indent=2)}")
-            print(f"✓ Token is valid")
-            print(f"  Expires in: {token_info.get('expires_in', 'unknown')} seconds")
-            print(f"  Scope: {token_info.get('scope', 'unknown')}")
-            print(f"  Audience (aud): {token_info.get('aud', 'unknown')}")
+            self.log.debug(f"Token info response: {json.dumps(token_info, indent=2)}")
+            self.log.info("✓ Token is valid")
+            self.log.info(f"  Expires in: {token_info.get('expires_in', 'unknown')} seconds")
+            self.log.info(f"  Scope: {token_info.get('scope', 'unknown')}")
+            self.log.info(f"  Audience (aud): {token_info.get('aud', 'unknown')}")
 
             # Get user email from userinfo endpoint to verify which account is authenticated
+            account = None
             try:
                 userinfo_url = 'https://www.googleapis.com/oauth2/v2/userinfo'
                 userinfo_headers = {'Authorization': f'Bearer {self.auth.token}'}
                 userinfo_req = urllib.request.Request(userinfo_url, headers=userinfo_headers)
                 userinfo_response = urllib.request.urlopen(userinfo_req)
                 userinfo = json.loads(userinfo_response.read().decode('utf-8'))
-                print(f"  Authenticated as: {userinfo.get('email', 'unknown')}")
+                account = userinfo.get('email')
+                self.log.info(f"  Authenticated as: {userinfo.get('email', 'unknown')}")
             except Exception as e:
-                print(f"  Could not fetch user email: {e}")
+                self.log.info(f"  Could not fetch user email: {e}")
 
             # Check if the scope includes photoslibrary
             scope = token_info.get('scope', '')
             if 'photoslibrary' not in scope:
-                print(f"\n⚠️  WARNING: Token does not include 'photoslibrary' scope!")
-                print(f"  This will cause API calls to fail.")
-                print(f"  Please check your OAuth consent screen configuration.")
+                self.log.warning("\n⚠️  WARNING: Token does not include 'photoslibrary' scope!")
+                self.log.warning("  This will cause API calls to fail.")
+                self.log.warning("  Please check your OAuth consent screen configuration.")
                 return
 
             # Test if Photos Library API is accessible
-            print("\nTesting Photos Library API access...")
+            self.log.info("\nTesting Photos Library API access...")
             try:
-                test_url = 'https://photoslibrary.googleapis.com/v1/mediaItems?pageSize=1'
+                test_url = f'{API_BASE}/mediaItems?pageSize=1'
                 headers = {
                     'Authorization': f'Bearer {self.auth.token}',
                     'Content-Type': 'application/json'
                 }
-                print(f"DEBUG: Test API URL: {test_url}")
-                print(f"DEBUG: Test API headers: {headers}")
                 test_req = urllib.request.Request(test_url, headers=headers)
                 test_response = urllib.request.urlopen(test_req)
-                print(f"✓ Photos Library API is accessible")
+                self.log.info("✓ Photos Library API is accessible")
+                self.auth.record_validation(account)
             except urllib.error.HTTPError as api_error:
                 error_body = api_error.read().decode('utf-8')
-                print(f"\n❌ Photos Library API test failed!")
-                print(f"   Status: {api_error.code}")
-                print(f"   Error: {error_body}")
+                self.log.error("\n❌ Photos Library API test failed!")
+                self.log.error(f"   Status: {api_error.code}")
+                self.log.error(f"   Error: {error_body}")
 
                 if api_error.code == 403:
-                    print(f"\n   DIAGNOSIS:")
-                    print(f"   Your token has the correct scope, but the API call is being rejected.")
-                    print(f"   This usually means:")
-                    print(f"   1. Photos Library API is NOT enabled in your Google Cloud project")
-                    print(f"   2. You are not added as a test user in the OAuth consent screen")
-                    print(f"   3. There's a mismatch between your credentials.json project and API settings")
-                    print(f"\n   Please verify:")
-                    print(f"   A. Go to: https://console.cloud.google.com/apis/library/photoslibrary.googleapis.com")
-                    print(f"      Make sure it shows 'API enabled' (green checkmark)")
-                    print(f"   B. Go to: https://console.cloud.google.com/apis/credentials/consent")
-                    print(f"      Under 'Test users', make sure your email is listed")
-                    print(f"   C. Check that your credentials.json is from the SAME project")
-                    print(f"\n   After fixing the configuration, delete token.pickle and run the script again.")
+                    self.log.error("\n   DIAGNOSIS:")
+                    self.log.error("   Your token has the correct scope, but the API call is being rejected.")
+                    self.log.error("   This usually means:")
+                    self.log.error("   1. Photos Library API is NOT enabled in your Google Cloud project")
+                    self.log.error("   2. You are not added as a test user in the OAuth consent screen")
+                    self.log.error("   3. There's a mismatch between your credentials.json project and API settings")
+                    self.log.error("\n   Please verify:")
+                    self.log.error("   A. Go to: https://console.cloud.google.com/apis/library/photoslibrary.googleapis.com")
+                    self.log.error("      Make sure it shows 'API enabled' (green checkmark)")
+                    self.log.error("   B. Go to: https://console.cloud.google.com/apis/credentials/consent")
+                    self.log.error("      Under 'Test users', make sure your email is listed")
+                    self.log.error("   C. Check that your credentials.json is from the SAME project")
+                    self.log.error("\n   After fixing the configuration, delete token.pickle and run the script again.")
 
                     # Exit to avoid confusing error messages
                     exit(1)
 
         except Exception as e:
-            print(f"⚠️  Token validation failed: {e}")
-            print(f"  This might cause issues with API requests.")
+            self.log.warning(f"⚠️  Token validation failed: {e}")
+            self.log.warning("  This might cause issues with API requests.")
 
     def _api_request(self, url, method='GET', body=None):
-        """Make authenticated API request"""
+        """Make authenticated API request
+
+        Goes through the request scheduler, so throttling and server errors
+        are retried there; only errors that survive the retries reach the
+        handling below.
+        """
         headers = {
             'Authorization': f'Bearer {self.auth.token}',
             'Content-Type': 'application/json'
         }
 
-        print(f"DEBUG: API Request - Method: {method}, URL: {url}")
-        print(f"DEBUG: Token (first 20 chars): {self.auth.token[:20] if self.auth.token else 'None'}")
-        print(f"DEBUG: Headers: {headers}")
-
+        self.log.debug("API request: %s %s", method, url)
         data = json.dumps(body).encode('utf-8') if body else None
-        req = urllib.request.Request(url, data=data, headers=headers, method=method)
+        endpoint = 'search' if urllib.parse.urlsplit(url).path.endswith(':search') else 'listing'
+
+        def send():
+            # Read the token per attempt; the background refresher may have
+            # replaced it since the request was first scheduled
+            headers['Authorization'] = f'Bearer {self.auth.token}'
+            with self.pool.request(method, url, body=data, headers=headers) as response:
+                return json.loads(response.read().decode('utf-8'))
 
         try:
-            response = urllib.request.urlopen(req)
-            return json.loads(response.read().decode('utf-8'))
+            try:
+                return self.scheduler.call(endpoint, send)
+            except urllib.error.HTTPError as e:
+                if e.code != 401 or not self.auth.refresh_token:
+                    raise
+                # The access token expired under us; refresh it and retry once
+                self.auth.refresh_now(stale_token=headers['Authorization'][len('Bearer '):])
+                return self.scheduler.call(endpoint, send)
         except urllib.error.HTTPError as e:
             error_body = e.read().decode('utf-8')
-            print(f"API Error: {e.code} - {error_body}")
+            self.log.error(f"API Error: {e.code} - {error_body}")
 
             # Check for scope/authentication issues
             if e.code == 403 or e.code == 401:
                 try:
-                    error_data = json.loads(error_body)
-                    error_message = error_data.get('error', {}).get('message', '')
-                    if 'insufficient authentication scopes' in error_message.lower() or 'invalid' in error_message.lower():
-                        print("\nAuthentication issue detected!")
-                        print("Deleting saved token and re-authenticating...")
-                        if os.path.exists(TOKEN_FILE):
-                            os.remove(TOKEN_FILE)
-                        print("\nPlease run the script again to re-authenticate with the correct scopes.")
-                        exit(1)
-                except:
-                    pass
+                    error_message = json.loads(error_body).get('error', {}).get('message', '').lower()
+                except (ValueError, AttributeError):
+                    error_message = ''
+                if 'insufficient authentication scopes' in error_message or 'invalid' in error_message:
+                    self.log.error("\nAuthentication issue detected!")
+                    self.log.error("Deleting saved token and re-authenticating...")
+                    if os.path.exists(self.auth.token_file):
+                        os.remove(self.auth.token_file)
+                    self.log.error("\nPlease run the script again to re-authenticate with the correct scopes.")
+                    # Raised rather than exit(), since this may run on a worker thread
+                    raise AuthError(error_message) from e
 
             raise
 
     def load_state(self):
-        if os.path.exists(STATE_FILE):
-            with open(STATE_FILE, 'r') as f:
-                state = json.load(f)
-                self.downloaded = set(state.get('downloaded', []))
-                print(f"Resumed: {len(self.downloaded)} files already downloaded")
+        self.downloaded = self.journal.load()
+        if self.downloaded:
+            self.log.info(f"Resumed: {len(self.downloaded)} files already downloaded")
+
+    def mark_downloaded(self, item_id):
+        """Record an item as stored; durable after the next batched flush"""
+        self.downloaded.add(item_id)
+        self.journal.add(item_id)
 
     def save_state(self):
-        with open(STATE_FILE, 'w') as f:
-            json.dump({'downloaded': list(self.downloaded)}, f)
+        """Force buffered journal records to disk"""
+        self.journal.flush()
 
     def get_filed_items(self):
-        """Fetch all albums and collect media item IDs"""
-        print("Fetching albums...")
-        url = 'https://photoslibrary.googleapis.com/v1/albums'
+        """Fetch all albums and collect media item IDs
+
+        Only albums whose item count changed are walked, in parallel. Items
+        that dropped out of an album are left in dropped_from_albums.
+        """
+        self.log.info(f"Fetching albums (up to {self.album_workers} in parallel)...")
+        self.phases.start('album scan')
+        url = f'{API_BASE}/albums'
         next_page = None
         album_count = 0
-
-        while True:
-            params = {'pageSize': 50}
-            if next_page:
-                params['pageToken'] = next_page
-
-            full_url = url + '?' + urllib.parse.urlencode(params)
-            data = self._api_request(full_url)
-
-            albums = data.get('albums', [])
-            album_count += len(albums)
-
-            for album in albums:
-                self._get_album_items(album['id'])
-
-            next_page = data.get('nextPageToken')
-            print(f"Processed {album_count} albums, {len(self.filed_ids)} filed items found")
-
-            if not next_page:
-                break
-
-        print(f"\nTotal filed items: {len(self.filed_ids)}")
+        albums_done = 0
+        albums_cached = 0
+        memberships = 0
+        live_ids = set()
+        pending = {}
+        last_full = float(self.catalog.get_meta('last_full_album_scan', 0))
+        full = self.full_rescan or time.time() - last_full >= FULL_RESCAN_DAYS * 86400
+        scanned_counts = {} if full else self.catalog.album_scanned_counts()
+        self.dropped_from_albums = set()
+
+        def collect(done):
+            nonlocal albums_done, memberships
+            for future in done:
+                album = pending.pop(future)
+                item_ids = future.result()
+                self.catalog.save_album(album, item_ids, left=self.dropped_from_albums)
+                memberships += len(item_ids)
+                albums_done += 1
+
+        with ThreadPoolExecutor(max_workers=self.album_workers) as pool:
+            while True:
+                params = {'pageSize': 50}
+                if next_page:
+                    params['pageToken'] = next_page
+
+                full_url = url + '?' + urllib.parse.urlencode(params)
+                data = self._api_request(full_url)
+
+                albums = data.get('albums', [])
+                album_count += len(albums)
+
+                for album in albums:
+                    live_ids.add(album['id'])
+                    count = int(album.get('mediaItemsCount', 0))
+                    if scanned_counts.get(album['id']) == count:
+                        # Membership is already in the catalog
+                        memberships += count
+                        albums_cached += 1
+                        albums_done += 1
+                    else:
+                        pending[pool.submit(self._get_album_items, album['id'])] = album
+
+                # Merge whatever has finished so progress stays visible
+                collect([f for f in list(pending) if f.done()])
+
+                next_page = data.get('nextPageToken')
+                self.log.info(f"Listed {album_count} albums, {albums_done} scanned "
+                              f"({albums_cached} unchanged), {memberships} album items found")
+
+                if not next_page:
+                    break
+
+            for future in as_completed(list(pending)):
+                collect([future])
+
+        removed = self.catalog.prune_albums(live_ids, left=self.dropped_from_albums)
+        if removed:
+            self.log.info(f"Removed {removed} deleted albums from the catalog")
+        if full:
+            self.catalog.set_meta('last_full_album_scan', time.time())
+        self.filed_ids = self._load_filed_index()
+        self.phases.stop('album scan')
+        self.log.info(f"\nTotal filed items: {len(self.filed_ids)} in {album_count} albums "
+                      f"({albums_cached} unchanged since last run)")
+
+    def _load_filed_index(self):
+        """Load the saved FiledIndex, or rebuild it if any album changed"""
+        version = self.catalog.membership_version()
+        index = FiledIndex.load(self.path(FILED_INDEX_FILE), version, verify=self.catalog.is_filed)
+        if index is None:
+            index = FiledIndex.build(self.catalog.iter_album_item_ids(), verify=self.catalog.is_filed)
+            index.save(self.path(FILED_INDEX_FILE), version)
+            self.log.debug("Rebuilt the filed item index (%d items)", len(index))
+        self.metrics.set('filed_items', len(index))
+        return index
 
     def _get_album_items(self, album_id):
-        """Get all media items in a specific album"""
-        url = 'https://photoslibrary.googleapis.com/v1/mediaItems:search'
+        """Get the IDs of all media items in a specific album"""
+        url = f'{API_BASE}/mediaItems:search'
         next_page = None
+        item_ids = []
 
         while True:
             body = {
@@ -413,17 +2362,62 @@ class PhotoDownloader:
             data = self._api_request(url, method='POST', body=body)
 
             items = data.get('mediaItems', [])
-            for item in items:
-                self.filed_ids.add(item['id'])
+            item_ids.extend(item['id'] for item in items)
 
             next_page = data.get('nextPageToken')
             if not next_page:
                 break
 
-    def get_all_items(self):
-        """Fetch all media items from library"""
-        print("\nFetching all media items...")
-        url = 'https://photoslibrary.googleapis.com/v1/mediaItems'
+        return item_ids
+
+    def iter_library(self, new_only=False):
+        """Yield every media item in the library as a MediaRecord
+
+        An incremental run stops listing at the first page the catalog
+        already knows and yields the rest from the catalog, unless new_only.
+        """
+        self.log.info("\nFetching all media items...")
+        self.phases.start('library scan')
+        fetched = 0
+        last_full = float(self.catalog.get_meta('last_full_scan', 0))
+        incremental = not self.full_rescan and time.time() - last_full < FULL_RESCAN_DAYS * 86400
+        scan_id = int(self.catalog.get_meta('scan_id', 0)) + 1
+        self.catalog.set_meta('scan_id', scan_id)
+        state = {'complete': True}
+
+        since = None
+        last_success = self.catalog.get_meta('last_success')
+        if self.since_last_run and last_success and incremental and not new_only:
+            # A day of slack covers timezone skew in creationTime
+            since = datetime.datetime.fromtimestamp(float(last_success), datetime.timezone.utc).date() - datetime.timedelta(days=1)
+            self.log.info(f"Listing only items dated {since} or later")
+
+        if (self.shard_library and not new_only) or since:
+            pages = self._search_shards(since, state)
+        else:
+            pages = self._list_pages(incremental, state)
+
+        for records in pages:
+            self.catalog.save_items(records, scan_id)
+            fetched += len(records)
+            self.metrics.inc('library_items_listed_total', len(records))
+            self.log.debug("Fetched %d items...", fetched)
+            yield from records
+
+        if state['complete']:
+            removed = self.catalog.prune_items(scan_id)
+            if removed:
+                self.log.info(f"Removed {removed} deleted items from the catalog")
+            self.catalog.set_meta('last_full_scan', time.time())
+        elif not new_only:
+            yield from self.catalog.iter_items(skip_scan=scan_id)
+
+        self.phases.stop('library scan')
+        self.log.info(f"Library listing finished ({fetched} items listed this run)")
+
+    def _list_pages(self, incremental, state):
+        """Yield pages of records from the plain /v1/mediaItems listing"""
+        url = f'{API_BASE}/mediaItems'
         next_page = None
 
         while True:
@@ -434,78 +2428,980 @@ class PhotoDownloader:
             full_url = url + '?' + urllib.parse.urlencode(params)
             data = self._api_request(full_url)
 
-            items = data.get('mediaItems', [])
-            self.all_items.extend(items)
-
-            print(f"Fetched {len(self.all_items)} total items...")
+            fetched_at = time.time()
+            records = [MediaRecord.from_api(item, fetched_at) for item in data.get('mediaItems', [])]
+            known = self.catalog.known_item_ids(r.id for r in records) if incremental else ()
+            yield records
 
             next_page = data.get('nextPageToken')
             if not next_page:
                 break
+            if records and len(known) == len(records):
+                self.log.info("Reached previously cataloged items, using catalog for the rest")
+                state['complete'] = False
+                break
 
-        print(f"Total items in library: {len(self.all_items)}")
+    def _search_shards(self, since, state):
+        """Yield pages of records from date-range shards listed in parallel
 
-    def download_unfiled(self, output_zip='unfiled_photos.zip'):
-        """Download items not in any album"""
-        unfiled = [item for item in self.all_items if item['id'] not in self.filed_ids]
-        print(f"\nFound {len(unfiled)} unfiled items")
+        One shard per year, halved down to single days while busy.
+        """
+        today = datetime.date.today()
+        end_of_time = datetime.date(9999, 12, 31)
+        if since:
+            shards = [(since, end_of_time)]
+        else:
+            shards = [(datetime.date(1, 1, 1), datetime.date(SHARD_FIRST_YEAR - 1, 12, 31))]
+            shards += [(datetime.date(year, 1, 1), datetime.date(year, 12, 31))
+                       for year in range(SHARD_FIRST_YEAR, today.year)]
+            shards.append((datetime.date(today.year, 1, 1), end_of_time))
+        if since:
+            state['complete'] = False
+
+        # IDs from the first page of split shards; the halves list them again
+        split_seen = set()
+        self.log.info(f"Listing library in {len(shards)} date shards, {self.library_workers} at a time")
+
+        with ThreadPoolExecutor(max_workers=self.library_workers) as pool:
+            pending = {pool.submit(self._search_page, shard, None): (shard, True) for shard in shards}
+            while pending:
+                done = next(as_completed(pending))
+                shard, first_page = pending.pop(done)
+                records, next_page = done.result()
+
+                start, end = shard
+                if first_page and next_page and start < end:
+                    mid = start + (end - start) // 2
+                    for half in ((start, mid), (mid + datetime.timedelta(days=1), end)):
+                        pending[pool.submit(self._search_page, half, None)] = (half, True)
+                    fresh = [r for r in records if r.id not in split_seen]
+                    split_seen.update(r.id for r in records)
+                    yield fresh
+                    continue
 
-        if not unfiled:
-            print("No unfiled items to download!")
-            return
+                if next_page:
+                    pending[pool.submit(self._search_page, shard, next_page)] = (shard, False)
+                yield [r for r in records if r.id not in split_seen] if split_seen else records
+
+    def _search_page(self, shard, page_token):
+        """Fetch one page of a date shard; returns (records, nextPageToken)"""
+        url = f'{API_BASE}/mediaItems:search'
+        start, end = shard
+        body = {
+            'pageSize': 100,
+            'filters': {'dateFilter': {'ranges': [{
+                'startDate': {'year': start.year, 'month': start.month, 'day': start.day},
+                'endDate': {'year': end.year, 'month': end.month, 'day': end.day},
+            }]}}
+        }
+        if page_token:
+            body['pageToken'] = page_token
+
+        data = self._api_request(url, method='POST', body=body)
+        fetched_at = time.time()
+        records = [MediaRecord.from_api(item, fetched_at) for item in data.get('mediaItems', [])]
+        return records, data.get('nextPageToken')
+
+    def iter_unfiled(self, library=None):
+        """Yield library items that are not in any album"""
+        for record in library if library is not None else self.iter_library():
+            if record.id not in self.filed_ids:
+                yield record
+
+    def run(self, output=None, pipeline=False):
+        """Scan albums and library, download unfiled items, report timings"""
+        started = time.time()
+        self.progress.start()
+        try:
+            if pipeline:
+                self._run_pipelined(output)
+            else:
+                self.get_filed_items()
+                self.download_unfiled(output)
+        finally:
+            self.progress.stop()
+        # Lets the next run list only what is dated since this one
+        self.catalog.set_meta('last_success', started)
+        self.phases.report(self.log)
+
+    def watch(self, output=None, interval=POLL_INTERVAL, pipeline=False):
+        """Sync once, then poll for changes every interval seconds
+
+        Returns once stop_watching() is called.
+        """
+        synced = False
+        status = self.watch_status
+        while True:
+            started = time.time()
+            status.update(state='polling' if synced else 'syncing', last_started=started)
+            try:
+                if synced:
+                    status['last_downloaded'] = self.poll(output)
+                else:
+                    self.run(output, pipeline)
+                    synced = True
+                    # A forced full rescan only applies to the first pass
+                    self.full_rescan = False
+                status['last_error'] = None
+            except AuthError:
+                # Retrying cannot help; the token has to be replaced
+                raise
+            except Exception as e:
+                self.log.error(f"Sync failed, retrying in {interval}s: {e}")
+                status['last_error'] = str(e)
+            status.update(state='idle', polls=status['polls'] + 1, last_finished=time.time(),
+                          next_poll=time.time() + interval)
+            self.metrics.set('watch_last_poll_seconds', round(time.time() - started, 3))
+            if self._stop_watching.wait(interval):
+                break
+        status['state'] = 'stopped'
+
+    def stop_watching(self):
+        """Make watch() return after the pass in progress"""
+        self._stop_watching.set()
+
+    def poll(self, output=None):
+        """Download whatever became unfiled since the last pass
+
+        Returns the number of items downloaded.
+        """
+        started = time.time()
+        self.get_filed_items()
+        dropped = self.dropped_from_albums
+        todo = []
+        for record in self.iter_unfiled(self.iter_library(new_only=True)):
+            dropped.discard(record.id)
+            if record.id not in self.downloaded:
+                todo.append(record)
+        for record in self.iter_unfiled(self.catalog.get_items(dropped)):
+            if record.id not in self.downloaded:
+                todo.append(record)
+
+        downloaded = 0
+        if todo:
+            before = self.metrics.value('downloaded_items_total')
+            self.progress.start()
+            try:
+                self.download_unfiled(output, library=todo)
+            finally:
+                self.progress.stop()
+            downloaded = int(self.metrics.value('downloaded_items_total') - before)
+        else:
+            self.log.info("No new unfiled items")
+        self.catalog.set_meta('last_success', started)
+        return downloaded
+
+    def status(self):
+        """Watch state plus headline counts, for the /status endpoint"""
+        status = dict(self.watch_status)
+        for key in ('last_started', 'last_finished', 'next_poll'):
+            if status.get(key):
+                status[key] = datetime.datetime.fromtimestamp(status[key], datetime.timezone.utc).isoformat()
+        status.update(downloaded=len(self.downloaded), filed=len(self.filed_ids),
+                      downloading=bool(self.metrics.value('downloading')))
+        return status
+
+    def _run_pipelined(self, output):
+        """Run the album scan and the library scan at the same time
+
+        The library listing runs on its own thread into a buffer of up to
+        pipeline_buffer records while the albums are scanned. Downloads
+        start as soon as the filed set is complete, draining that buffer
+        while the listing carries on behind it.
+        """
+        stop = threading.Event()
+        records = queue.Queue(maxsize=self.pipeline_buffer)
+        done = object()
+        list_error = []
+
+        def put(value):
+            # Give up instead of blocking forever once the downloads have stopped
+            while not stop.is_set():
+                try:
+                    records.put(value, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
 
-        os.makedirs('temp_downloads', exist_ok=True)
+        def list_library():
+            try:
+                for record in self.iter_library():
+                    if not put(record):
+                        return
+            except Exception as e:
+                list_error.append(e)
+            finally:
+                put(done)
+
+        def library():
+            while True:
+                record = records.get()
+                if record is done:
+                    break
+                yield record
+            if list_error:
+                raise list_error[0]
+
+        def depths():
+            return [('queue_depth', {'queue': 'pipeline'}, records.qsize())]
+
+        self.metrics.collect(depths)
+        try:
+            threading.Thread(target=list_library, daemon=True).start()
+            self.get_filed_items()
+            self.download_unfiled(output, library=library())
+        finally:
+            stop.set()
+            self.metrics.discard(depths)
+
+    def download_unfiled(self, output=None, library=None):
+        """Download items not in any album
+
+        Items stream from the library listing through bounded queues, so
+        memory use does not grow with the library.
+        """
+        counts = {'unfiled': 0, 'skipped': 0}
+        self.duplicates = 0
+
+        def pending():
+            for record in self.iter_unfiled(library):
+                counts['unfiled'] += 1
+                if record.id in self.downloaded:
+                    counts['skipped'] += 1
+                else:
+                    self.metrics.inc('download_items_queued_total')
+                    yield record
+            self.metrics.set('listing_complete', 1)
+
+        self.phases.start('download')
+        output = output or DEFAULT_OUTPUTS[self.sink]
+        if output != '-':
+            output = self.path(output)
+        downloaded = self._run_downloads(self._with_fresh_urls(pending()), output)
+        self.phases.stop('download')
+
+        self.log.info(f"\nFound {counts['unfiled']} unfiled items: {downloaded} downloaded, "
+                      f"{counts['skipped']} already downloaded")
+        if self.duplicates:
+            self.log.info(f"{self.duplicates} downloads were identical to content already stored")
+        if self.url_refreshes:
+            self.log.info(f"Refreshed {self.url_refreshes} expired baseUrls")
+        if not counts['unfiled']:
+            self.log.info("No unfiled items to download!")
+            return
 
-        with ZipFile(output_zip, 'a') as zipf:
-            for i, item in enumerate(unfiled, 1):
-                item_id = item['id']
+        self.log.info(f"\nDownload complete! Saved to {'standard output' if output == '-' else output}")
+
+    def _run_downloads(self, items, output):
+        """Fan items out to download workers and write results to the sink
+
+        items may be any iterable, including a generator that is still
+        listing the library; it is consumed on a feeder thread. Finished
+        downloads are routed to the sink's writer threads (a single one
+        unless writing multi-volume or directory output). Returns the
+        number of items written.
+        """
+        stop = threading.Event()
+        todo = queue.Queue(maxsize=self.max_in_flight)
+        results = queue.Queue(maxsize=self.max_in_flight)
+        workers = self.download_workers
+        feed_error = []
+
+        def put(q, value):
+            # Give up instead of blocking forever once the writer has stopped
+            while not stop.is_set():
+                try:
+                    q.put(value, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
 
-                if item_id in self.downloaded:
-                    print(f"[{i}/{len(unfiled)}] Skipping (already downloaded): {item['filename']}")
+        def feed():
+            try:
+                for item in items:
+                    if not put(todo, item):
+                        return
+            except BaseException as e:
+                feed_error.append(e)
+            finally:
+                # Always release the workers, whatever ended the listing
+                for _ in range(workers):
+                    put(todo, None)
+
+        def work():
+            while not stop.is_set():
+                try:
+                    item = todo.get(timeout=0.5)
+                except queue.Empty:
                     continue
-
+                if item is None:
+                    break
+                # A slot in the (possibly shared) worker pool bounds downloads
+                self.worker_pool.acquire(self)
                 try:
-                    # Determine download URL based on media type
-                    if 'video' in item['mimeType']:
-                        download_url = f"{item['baseUrl']}=dv"
-                    else:
-                        download_url = f"{item['baseUrl']}=d"
-
-                    filename = item['filename']
-                    temp_path = os.path.join('temp_downloads', filename)
+                    result = (item, self._download_item(item), None)
+                except Exception as e:
+                    result = (item, None, e)
+                finally:
+                    self.worker_pool.release()
+                if not put(results, result):
+                    return
+            put(results, None)
+
+        sink = self._open_sink(output)
+        inboxes = [queue.Queue(maxsize=2) for _ in range(sink.writers)]
+        write_error = []
+        self._stored = 0
+        self._store_lock = threading.Lock()
+
+        def write(inbox):
+            # Each writer owns its target (a ZIP volume, or the shared tree)
+            target = None
+            try:
+                target = sink.open()
+                while True:
+                    try:
+                        result = inbox.get(timeout=0.5)
+                    except queue.Empty:
+                        if stop.is_set():
+                            break
+                        continue
+                    if result is None:
+                        break
+                    if target.full():
+                        previous, target = target, None
+                        previous.close()
+                        target = sink.open()
+                    self._store(target, *result)
+            except Exception as e:
+                write_error.append(e)
+                stop.set()
+            finally:
+                if target is not None:
+                    target.close()
+
+        threads = [threading.Thread(target=feed, daemon=True)]
+        threads += [threading.Thread(target=work, daemon=True) for _ in range(workers)]
+        writers = [threading.Thread(target=write, args=(inbox,), daemon=True) for inbox in inboxes]
+        for t in threads + writers:
+            t.start()
+
+        def depths():
+            return [('queue_depth', {'queue': 'download'}, todo.qsize()),
+                    ('queue_depth', {'queue': 'downloaded'}, results.qsize()),
+                    ('queue_depth', {'queue': 'write'}, sum(inbox.qsize() for inbox in inboxes))]
+
+        self.metrics.collect(depths)
+        self.metrics.set('downloading', 1)
+        try:
+            finished = 0
+            while finished < workers and not stop.is_set():
+                # Workers stop without a marker once stop is set, so poll
+                try:
+                    result = results.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if result is None:
+                    finished += 1
+                    continue
 
-                    print(f"[{i}/{len(unfiled)}] Downloading: {filename}")
+                item, body, error = result
+                if error is not None:
+                    self.metrics.inc('download_errors_total')
+                    self.log.error(f"Error downloading {item.filename}: {error}")
+                    continue
 
-                    # Download file
-                    urllib.request.urlretrieve(download_url, temp_path)
+                # Hand off to the least busy writer
+                if not put(min(inboxes, key=queue.Queue.qsize), result):
+                    break
+            for inbox in inboxes:
+                put(inbox, None)
+        finally:
+            stop.set()
+            for t in writers:
+                t.join()
+            self.save_state()
+            self.metrics.set('downloading', 0)
+            self.metrics.discard(depths)
+
+        if write_error:
+            raise write_error[0]
+        if feed_error:
+            raise feed_error[0]
+        return self._stored
+
+    def _open_sink(self, output):
+        """Create the sink selected by self.sink for output (a path, or '-')"""
+        if self.sink == 'dir':
+            return DirectorySink(output, self.volume_writers)
+        if self.sink == 'tar':
+            if output == '-':
+                # The real stdout; progress messages belong on stderr here
+                return TarStreamSink(sys.__stdout__.buffer)
+            # Never overwrite an earlier run's stream of different items
+            return TarStreamSink(open(output, 'xb'), output, close_stream=True)
+        return ZipSink(output, self.index, self.volume_size, self.volume_items, self.volume_writers,
+                       self.log)
+
+    def _store(self, target, item, body, error):
+        """Write one downloaded item to a sink target and record it"""
+        filename = item.filename
+        head, response = body
+        try:
+            # Store under a name no other item has claimed
+            name = target.claim_name(self.index, item)
+            digest, size, existing = target.add(name, item, head, response, self.index.find)
+            if isinstance(response, ResumableDownload):
+                response.remove()
+            if existing:
+                self.index.record(item.id, digest, size, *existing, duplicate=True)
+            else:
+                self.index.record(item.id, digest, size, target.archive, name)
+
+            # Mark as downloaded (journaled, fsynced in batches)
+            self.mark_downloaded(item.id)
+            with self._store_lock:
+                self._stored += 1
+                if existing:
+                    self.duplicates += 1
+            self.metrics.inc('downloaded_items_total')
+            self.metrics.inc('downloaded_bytes_total', size)
+            if existing:
+                self.metrics.inc('duplicate_items_total')
+                self.log.debug("Duplicate of %s in %s, not stored again: %s", existing[1], existing[0], filename)
+            else:
+                self.log.debug("Downloaded: %s", name)
+        except Exception as e:
+            self.metrics.inc('download_errors_total')
+            self.log.error(f"Error downloading {filename}: {e}")
+
+    def _download_item(self, item):
+        """Download one media item for the writer
+
+        Returns (head, body): head holds the whole body if it fits in
+        SPOOL_LIMIT and body is None; otherwise body is a SpooledBody, or a
+        ResumableDownload for bodies over RESUME_THRESHOLD (or with a
+        checkpoint from an earlier run). Either way the network reads are
+        done here, on the worker thread.
+        """
+        def fetch(headers=None):
+            return self.scheduler.call('media', lambda: self.pool.request('GET', item.download_url,
+                                                                         headers=headers))
+
+        partial = ResumableDownload(item, self.path(PARTIAL_DIR), self.log)
+        if partial.checkpointed:
+            self.log.info(f"Resuming {item.filename} at byte {partial.received} of {partial.meta['size']}")
+            partial.fetch(fetch, segments=self.range_segments)
+            return b'', partial
 
-                    # Add to zip
-                    zipf.write(temp_path, filename)
-                    os.remove(temp_path)
+        try:
+            response = fetch()
+        except urllib.error.HTTPError as e:
+            if e.code != 403:
+                raise
+            # An expired baseUrl answers 403; refresh it and try once more
+            if not self._refresh_base_urls([item]):
+                raise
+            response = fetch()
 
-                    # Mark as downloaded and save state
-                    self.downloaded.add(item_id)
-                    self.save_state()
-
-                except Exception as e:
-                    print(f"Error downloading {filename}: {e}")
-                    continue
+        if int(response.headers.get('Content-Length') or 0) > RESUME_THRESHOLD:
+            partial.fetch(fetch, first_response=response, segments=self.range_segments)
+            return b'', partial
 
         try:
-            os.rmdir('temp_downloads')
-        except:
-            pass
-
-        print(f"\nDownload complete! Saved to {output_zip}")
+            head = bytearray()
+            while len(head) <= SPOOL_LIMIT:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    response.close()
+                    _check_length(response, len(head))
+                    return bytes(head), None
+                head += chunk
+        except Exception:
+            response.close()
+            raise
+        return b'', SpooledBody(bytes(head), response)
+
+    def _with_fresh_urls(self, items):
+        """Pass items through, refreshing stale baseUrls just in time
+
+        Items whose baseUrl is older than BASE_URL_TTL are held back until
+        BATCH_GET_SIZE of them have gathered (or the stream ends) and are
+        then refreshed with one mediaItems:batchGet call. Because this runs
+        right in front of the bounded download queue, a refreshed URL is
+        used within moments rather than expiring again in a long backlog.
+        """
+        stale = []
+        for item in items:
+            if time.time() - item.fetched_at <= BASE_URL_TTL:
+                yield item
+                continue
+            stale.append(item)
+            if len(stale) >= BATCH_GET_SIZE:
+                yield from self._refresh_base_urls(stale)
+                stale = []
+        if stale:
+            yield from self._refresh_base_urls(stale)
+
+    def _refresh_base_urls(self, items):
+        """Fetch fresh baseUrls for up to BATCH_GET_SIZE items in one call
+
+        Updates the records in place and returns those that still exist;
+        items the API no longer returns are reported and dropped.
+        """
+        params = [('mediaItemIds', item.id) for item in items]
+        url = f'{API_BASE}/mediaItems:batchGet?' + urllib.parse.urlencode(params)
+        data = self._api_request(url)
+        fetched_at = time.time()
+
+        fresh = {}
+        for result in data.get('mediaItemResults', []):
+            media_item = result.get('mediaItem')
+            if media_item:
+                fresh[media_item['id']] = media_item['baseUrl']
+
+        refreshed = []
+        for item in items:
+            if item.id in fresh:
+                item.base_url = fresh[item.id]
+                item.fetched_at = fetched_at
+                refreshed.append(item)
+            else:
+                self.log.warning(f"Error refreshing {item.filename}: item is no longer available")
+        self.catalog.update_base_urls(refreshed)
+        with self._refresh_lock:
+            self.url_refreshes += len(refreshed)
+        return refreshed
+
+    def verify(self, workers=VERIFY_WORKERS):
+        """Check what the content index says is stored, and reconcile
+
+        Missing and damaged entries are dropped from the output, the index
+        and the downloaded set. Returns the IDs to download again.
+        """
+        self.log.info(f"\nVerifying stored items ({workers} in parallel)...")
+        self.phases.start('verify')
+        indexed = set(self.index.item_ids())
+        stored = set()
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            for archive in self.index.archives():
+                kind = _archive_kind(archive)
+                if kind == 'tar':
+                    self.log.info(f"{archive}: tar output cannot be checked, left as it is")
+                else:
+                    expected = self.index.stored_entries(archive)
+                    if kind == 'dir':
+                        bad = self._verify_tree(archive, expected, pool)
+                    else:
+                        bad = self._verify_zip(archive, expected, pool)
+                    self.index.forget_entries(archive, bad)
+                stored.update(self.index.item_ids(archive))
+
+        unchecked = self.downloaded - indexed
+        downloaded = stored | unchecked
+        lost = self.downloaded - downloaded
+        found = downloaded - self.downloaded
+        for item_id in lost:
+            self.journal.discard(item_id)
+        for item_id in found:
+            self.journal.add(item_id)
+        self.journal.flush()
+        self.downloaded = downloaded
+        self.phases.stop('verify')
+
+        self.log.info(f"Verified: {len(downloaded)} items stored, {len(lost)} to download again, "
+                      f"{len(found)} stored but not yet recorded as downloaded")
+        if unchecked:
+            self.log.info(f"{len(unchecked)} items downloaded before the content index existed were not checked")
+        return lost
+
+    def _verify_zip(self, archive, expected, pool):
+        """Check a ZIP's indexed entries; return the names missing or damaged"""
+        if not os.path.exists(archive):
+            self.log.warning(f"{archive}: missing, {len(expected)} entries to download again")
+            return set(expected)
+        entries, end, recovered = _zip_entries(archive)
+        found = {info.filename: info for info in entries}
+        missing = set(expected).difference(found)
+        to_check = [found[name] for name in expected if name in found]
+        damaged = set()
+        if to_check:
+            with open(archive, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                def check(batch):
+                    return [info.filename for info in batch
+                            if info.file_size != expected[info.filename][1] or not _check_zip_entry(mm, info)]
+                batches = (to_check[i:i + VERIFY_BATCH] for i in range(0, len(to_check), VERIFY_BATCH))
+                for names in pool.map(check, batches):
+                    damaged.update(names)
+
+        if recovered or damaged:
+            _rewrite_central_directory(archive, [info for info in entries if info.filename not in damaged], end)
+        self.log.info(f"{archive}: {len(to_check) - len(damaged)} entries intact, {len(damaged)} damaged, "
+                      f"{len(missing)} missing"
+                      + (f"; central directory rebuilt from {len(entries)} entries" if recovered else ""))
+        return missing | damaged
+
+    def _verify_tree(self, root, expected, pool):
+        """Check a directory tree's indexed files; return the names missing or damaged
+
+        Damaged files are renamed to <name>.damaged so the fresh download
+        can take their place.
+        """
+        def check(batch):
+            return [name for name, (digest, size) in batch
+                    if not _check_file(os.path.join(root, *name.split('/')), size, digest)]
+
+        items = list(expected.items())
+        batches = (items[i:i + VERIFY_BATCH] for i in range(0, len(items), VERIFY_BATCH))
+        bad = set()
+        for names in pool.map(check, batches):
+            bad.update(names)
+        damaged = 0
+        for name in bad:
+            path = os.path.join(root, *name.split('/'))
+            if os.path.exists(path):
+                os.replace(path, path + '.damaged')
+                damaged += 1
+        self.log.info(f"{root}: {len(items) - len(bad)} files intact, {damaged} damaged, "
+                      f"{len(bad) - damaged} missing")
+        return bad
+
+    def close(self):
+        """Stop token refresh, flush the journal and close local databases and connections"""
+        self.auth.stop_auto_refresh()
+        self.journal.close()
+        self.catalog.close()
+        self.index.close()
+        if self._owns_pool:
+            self.pool.close()
+
+    def print_network_stats(self):
+        """Report request throttling, and connection reuse if the pool is ours
+
+        A pool shared between profiles is reported once by its owner.
+        """
+        if self._owns_pool:
+            self.pool.report(self.log)
+
+        self.log.info("\nRequest scheduling:")
+        for endpoint, counts in sorted(self.scheduler.stats().items()):
+            self.log.info(f"  {endpoint}: {counts['requests']} requests, {counts['retries']} retries, "
+                          f"{counts['throttled']} throttled, concurrency now {counts['concurrency']}")
+
+def _discard_entry(zipf, zinfo, previous):
+    """Roll the most recently written entry back out of an open ZipFile"""
+    if zinfo in zipf.filelist:
+        # Closing the entry registered it; drop it and let the next
+        # central directory overwrite (and truncate) its bytes
+        zipf.filelist.remove(zinfo)
+        if previous is None:
+            del zipf.NameToInfo[zinfo.filename]
+        else:
+            zipf.NameToInfo[zinfo.filename] = previous
+        zipf.start_dir = zinfo.header_offset
+        zipf.fp.seek(zinfo.header_offset)
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')  # ZIP local file header, up to the name
+
+def _zip_entries(path):
+    """Return (entries, end, recovered) for a ZIP archive on disk
+
+    entries come from the central directory when it can be read. After a
+    crash while appending it usually cannot, since new entries are written
+    over it; they are then rebuilt from the local file headers, recovered
+    is True and end is where the last complete entry stops.
+    """
+    try:
+        with ZipFile(path) as zipf:
+            return zipf.infolist(), zipf.start_dir, False
+    except BadZipFile:
+        pass
+    with open(path, 'rb') as f:
+        if not os.fstat(f.fileno()).st_size:
+            return [], 0, True
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            entries, end = _scan_local_headers(mm)
+    return entries, end, True
+
+def _scan_local_headers(mm):
+    """Rebuild ZipInfos by hopping from one local file header to the next
+
+    Only the headers are read, never the data between them. Stops at the
+    first header that is missing, cut short or defers its sizes to a data
+    descriptor, and at an entry not followed by another header or the end
+    of the file: one cut off mid-write still has its placeholder sizes.
+    Returns the entries and the offset where the last one ends.
+    """
+    entries = []
+    offset = 0
+    while offset + LOCAL_HEADER.size <= len(mm):
+        (magic, version, flags, method, dostime, dosdate, crc, compress_size, file_size,
+         name_length, extra_length) = LOCAL_HEADER.unpack_from(mm, offset)
+        if magic != b'PK\x03\x04' or flags & 0x08:
+            break
+        start = offset + LOCAL_HEADER.size
+        name = mm[start:start + name_length]
+        extra = mm[start + name_length:start + name_length + extra_length]
+        if 0xFFFFFFFF in (file_size, compress_size):
+            # Entries written with force_zip64 keep both sizes in the extra field
+            values = _zip64_values(extra)
+            try:
+                if file_size == 0xFFFFFFFF:
+                    file_size = values.pop(0)
+                if compress_size == 0xFFFFFFFF:
+                    compress_size = values.pop(0)
+            except IndexError:
+                break
+        end = start + name_length + extra_length + compress_size
+        if end != len(mm) and mm[end:end + 4] != b'PK\x03\x04':
+            break
+        info = ZipInfo(name.decode('utf-8' if flags & 0x800 else 'cp437'),
+                       ((dosdate >> 9) + 1980, (dosdate >> 5) & 0xF, dosdate & 0x1F,
+                        dostime >> 11, (dostime >> 5) & 0x3F, (dostime & 0x1F) * 2))
+        info.compress_type = method
+        info.flag_bits = flags
+        info.extract_version = version
+        info.CRC = crc
+        info.compress_size = compress_size
+        info.file_size = file_size
+        info.header_offset = offset
+        entries.append(info)
+        offset = end
+    return entries, offset
+
+def _zip64_values(extra):
+    """The 8-byte values of the ZIP64 field in an extra block, if any"""
+    pos = 0
+    try:
+        while pos + 4 <= len(extra):
+            tag, length = struct.unpack_from('<HH', extra, pos)
+            if tag == 1:
+                return list(struct.unpack_from(f'<{length // 8}Q', extra, pos + 4))
+            pos += 4 + length
+    except struct.error:
+        pass
+    return []
+
+def _check_zip_entry(mm, info):
+    """True if an entry's local header is sound and its data matches its CRC"""
+    offset = info.header_offset
+    if offset + LOCAL_HEADER.size > len(mm):
+        return False
+    magic, *_, name_length, extra_length = LOCAL_HEADER.unpack_from(mm, offset)
+    start = offset + LOCAL_HEADER.size + name_length + extra_length
+    end = start + info.compress_size
+    if magic != b'PK\x03\x04' or end > len(mm):
+        return False
+    # zlib works on the mapped pages directly and without the GIL, so
+    # entries checked on several threads really are read in parallel
+    with memoryview(mm) as view, view[start:end] as data:
+        if info.compress_type == ZIP_STORED:
+            return len(data) == info.file_size and zlib.crc32(data) == info.CRC
+        if info.compress_type != ZIP_DEFLATED:
+            return True  # Never written by this script; nothing to check it with
+        crc, size = 0, 0
+        inflate = zlib.decompressobj(-15)
+        try:
+            for pos in range(0, len(data), CHUNK_SIZE):
+                chunk = inflate.decompress(data[pos:pos + CHUNK_SIZE])
+                crc, size = zlib.crc32(chunk, crc), size + len(chunk)
+            chunk = inflate.flush()
+        except zlib.error:
+            return False
+        crc, size = zlib.crc32(chunk, crc), size + len(chunk)
+        return size == info.file_size and crc == info.CRC
+
+def _check_file(path, size, digest):
+    """True if the file at path has the given size and SHA-256"""
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size != size:
+                return False
+            if not size:
+                return hashlib.sha256().hexdigest() == digest
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return hashlib.sha256(mm).hexdigest() == digest
+    except OSError:
+        return False
+
+def _rewrite_central_directory(path, entries, end):
+    """Give an archive a new central directory listing just entries
+
+    The directory is written at end and the file truncated after it.
+    Entries left out keep their bytes but are no longer in the archive.
+    """
+    with ZipFile(path, 'a') as zipf:
+        zipf.filelist = list(entries)
+        zipf.NameToInfo = {info.filename: info for info in entries}
+        zipf.start_dir = end
+        # Make close() write the directory although nothing was added
+        zipf._didModify = True
+
+def _archive_kind(archive):
+    """'zip', 'dir' or 'tar', judging by what is on disk at archive"""
+    if archive == '<stdout>':
+        return 'tar'
+    if os.path.isdir(archive):
+        return 'dir'
+    if os.path.exists(archive):
+        return 'tar' if tarfile.is_tarfile(archive) else 'zip'
+    return 'tar' if archive.endswith('.tar') else 'zip'
+
+def _read_body(head, response):
+    """Yield a downloaded body: the buffered head, then the rest of response"""
+    if head:
+        yield head
+    if response is None:
+        return
+    received = len(head)
+    with response:
+        while True:
+            chunk = response.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            received += len(chunk)
+            yield chunk
+    _check_length(response, received)
+
+def _creation_time(item):
+    """Return an item's creationTime as an aware datetime, or None"""
+    try:
+        return datetime.datetime.strptime(item.creation_time[:19], '%Y-%m-%dT%H:%M:%S').replace(
+            tzinfo=datetime.timezone.utc)
+    except (TypeError, ValueError):
+        return None
+
+def _format_duration(seconds):
+    """Format seconds as e.g. 45s, 12m05s or 3h20m"""
+    seconds = int(seconds)
+    if seconds < 60:
+        return f"{seconds}s"
+    if seconds < 3600:
+        return f"{seconds // 60}m{seconds % 60:02d}s"
+    return f"{seconds // 3600}h{seconds % 3600 // 60:02d}m"
+
+def _check_length(response, received):
+    """Raise if fewer bytes arrived than the response's Content-Length"""
+    expected = response.headers.get('Content-Length')
+    if expected is not None and int(expected) != received:
+        raise IOError(f"incomplete download: got {received} of {expected} bytes")
+
+def parse_size(text):
+    """Parse a byte count such as 500M or 4G"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Download Google Photos items that are not in any album')
+    parser.add_argument('--album-workers', type=int, default=ALBUM_WORKERS,
+                        help=f'albums to scan concurrently (default: {ALBUM_WORKERS})')
+    parser.add_argument('--full-rescan', action='store_true',
+                        help='walk every album and the whole library even if the catalog is current')
+    parser.add_argument('--shard-library', action='store_true',
+                        help='list the library as date ranges fetched in parallel')
+    parser.add_argument('--library-workers', type=int, default=LIBRARY_WORKERS,
+                        help=f'date ranges listed concurrently with --shard-library (default: {LIBRARY_WORKERS})')
+    parser.add_argument('--since-last-run', action='store_true',
+                        help='only list items dated on or after the last successful run')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='scan albums and the library at the same time and start downloading '
+                             'as soon as the album scan is done')
+    parser.add_argument('--pipeline-buffer', type=int, default=PIPELINE_BUFFER,
+                        help=f'library items buffered while the album scan finishes (default: {PIPELINE_BUFFER})')
+    parser.add_argument('--range-segments', type=int, default=RANGE_SEGMENTS,
+                        help='parallel byte ranges used for each very large item (default: 1)')
+    parser.add_argument('--volume-size', type=parse_size,
+                        help='split output into numbered ZIP volumes of about this size, e.g. 4G')
+    parser.add_argument('--volume-items', type=int,
+                        help='split output into numbered ZIP volumes of at most this many items')
+    parser.add_argument('--volume-writers', type=int, default=VOLUME_WRITERS,
+                        help=f'volumes (or files, with --sink dir) written in parallel (default: {VOLUME_WRITERS})')
+    parser.add_argument('--log-level', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR'], default='INFO',
+                        help='DEBUG adds a line per item and request (default: INFO)')
+    parser.add_argument('--progress-interval', type=float, default=PROGRESS_INTERVAL,
+                        help=f'seconds between progress and ETA lines (default: {PROGRESS_INTERVAL})')
+    parser.add_argument('--metrics-file',
+                        help='rewrite this file with a JSON metrics snapshot every progress interval')
+    parser.add_argument('--metrics-port', type=int,
+                        help='serve Prometheus metrics at http://127.0.0.1:PORT/metrics '
+                             '(and, with --watch, a status summary at /status)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep running, polling for new unfiled items and downloading them')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL,
+                        help=f'seconds between polls with --watch (default: {POLL_INTERVAL})')
+    parser.add_argument('--sink', choices=sorted(DEFAULT_OUTPUTS), default='zip',
+                        help='write a ZIP archive, a year/month directory tree, or a tar stream (default: zip)')
+    parser.add_argument('--output',
+                        help='output path; "-" streams a tar to stdout '
+                             '(default: unfiled_photos.zip, unfiled_photos/ or stdout, by --sink)')
+    parser.add_argument('--download-workers', type=int, default=DOWNLOAD_WORKERS,
+                        help=f'media items to download concurrently, across all profiles (default: {DOWNLOAD_WORKERS})')
+    parser.add_argument('--profile', action='append', metavar='DIR',
+                        help='account directory holding credentials.json, token, state and output; '
+                             'repeat to download several accounts at once (default: current directory)')
+    parser.add_argument('--verify', action='store_true',
+                        help='check stored items against the archive first and download again '
+                             'only what is missing or damaged')
+    parser.add_argument('--verify-workers', type=int, default=VERIFY_WORKERS,
+                        help=f'entries checked in parallel with --verify (default: {VERIFY_WORKERS})')
+    parser.add_argument('--bandwidth', type=parse_size,
+                        help='cap total download speed in bytes per second, e.g. 20M (default: unlimited)')
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT,
+                        help=f'downloaded items allowed to queue for the ZIP writer (default: {MAX_IN_FLIGHT})')
+    args = parser.parse_args(argv)
+    if args.output == '-' and args.sink != 'tar':
+        parser.error('only --sink tar can write to stdout')
+    if args.sink != 'zip' and (args.volume_size or args.volume_items):
+        parser.error('--volume-size and --volume-items only apply to --sink zip')
+    if args.watch and args.sink == 'tar':
+        parser.error('--watch cannot append to a tar stream; use --sink zip or dir')
+    if args.profile and len(args.profile) > 1:
+        if args.sink == 'tar' and (args.output or '-') == '-':
+            parser.error('several profiles cannot share stdout; give --output a file name')
+        if args.output and os.path.isabs(args.output):
+            parser.error('with several profiles --output must be relative to each profile directory')
+    return args
+
+def sync(downloader, args):
+    """Run one profile's downloader once, or keep it polling with --watch
+
+    Returns False if the API rejected the profile's token (already reported).
+    """
+    try:
+        if args.watch:
+            downloader.watch(args.output, args.poll_interval, pipeline=args.pipeline)
+        else:
+            downloader.run(args.output, pipeline=args.pipeline)
+    except AuthError:
+        return False
+    return True
 
 def main():
+    args = parse_args()
+    if args.sink == 'tar' and (args.output or '-') == '-':
+        # stdout carries the archive, so everything else goes to stderr
+        sys.stdout = sys.stderr
+    level = getattr(logging, args.log_level)
+    logging.basicConfig(level=level, stream=sys.stdout,
+                        format='%(message)s' if level > logging.DEBUG
+                        else '%(asctime)s %(levelname)s [%(threadName)s] %(message)s')
+
     print("=" * 60)
     print("Google Photos Unfiled Downloader")
     print("=" * 60)
     print()
 
-    if not os.path.exists('credentials.json'):
-        print("ERROR: credentials.json not found!")
+    homes = args.profile or [None]
+    missing = [os.path.join(home or '', 'credentials.json') for home in homes
+               if not os.path.exists(os.path.join(home or '', 'credentials.json'))]
+    if missing:
+        for path in missing:
+            print(f"ERROR: {path} not found!")
         print("\nPlease follow these steps:")
         print("1. Go to https://console.cloud.google.com/")
         print("2. Create a new project (or select existing one)")
@@ -528,14 +3424,79 @@ def main():
         print("   - Go to 'APIs & Services' > 'Credentials'")
         print("   - Click 'Create Credentials' > 'OAuth client ID'")
         print("   - Choose 'Desktop app' as application type")
-        print("   - Download as 'credentials.json' in this directory")
+        print("   - Download as 'credentials.json' in this directory (or each --profile directory)")
         return
 
-    downloader = PhotoDownloader()
-    downloader.authenticate()
-    downloader.get_filed_items()
-    downloader.get_all_items()
-    downloader.download_unfiled()
+    # Profiles share connections, download slots and the bandwidth budget
+    bandwidth = TokenBucket(args.bandwidth, args.bandwidth) if args.bandwidth else None
+    pool = ConnectionPool(bandwidth=bandwidth)
+    worker_pool = WorkerPool(args.download_workers)
+    downloaders = [PhotoDownloader(album_workers=args.album_workers,
+                                   download_workers=args.download_workers,
+                                   max_in_flight=args.max_in_flight,
+                                   full_rescan=args.full_rescan,
+                                   pipeline_buffer=args.pipeline_buffer,
+                                   range_segments=args.range_segments,
+                                   shard_library=args.shard_library,
+                                   library_workers=args.library_workers,
+                                   since_last_run=args.since_last_run,
+                                   volume_size=args.volume_size,
+                                   volume_items=args.volume_items,
+                                   volume_writers=args.volume_writers,
+                                   sink=args.sink,
+                                   metrics_file=args.metrics_file,
+                                   progress_interval=args.progress_interval,
+                                   home=home,
+                                   name=os.path.basename(os.path.normpath(home)) if len(homes) > 1 else None,
+                                   pool=pool,
+                                   worker_pool=worker_pool)
+                   for home in homes]
+    if args.metrics_port is not None:
+        # One port per profile, counting up from --metrics-port
+        for port, downloader in enumerate(downloaders, args.metrics_port):
+            serve_metrics(downloader.metrics, port, status=downloader.status if args.watch else None,
+                          logger=downloader.log)
+    if args.verify:
+        for downloader in downloaders:
+            downloader.verify(args.verify_workers)
+    for downloader in downloaders:
+        downloader.authenticate()
+
+    if args.watch:
+        signal.signal(signal.SIGTERM, lambda signum, frame: [d.stop_watching() for d in downloaders])
+        log.info(f"Watching for new unfiled items every {args.poll_interval:g}s (Ctrl+C to stop)")
+    results = []
+    try:
+        if len(downloaders) == 1:
+            results.append(sync(downloaders[0], args))
+        else:
+            def sync_profile(downloader):
+                # Anything uncaught here would only reach threading.excepthook
+                try:
+                    results.append(sync(downloader, args))
+                except Exception as e:
+                    downloader.log.error(f"Sync failed: {e}")
+                    results.append(False)
+
+            threads = [threading.Thread(target=sync_profile, args=(d,), name=d.name, daemon=True)
+                       for d in downloaders]
+            for t in threads:
+                t.start()
+            for t in threads:
+                # Join in slices so Ctrl+C still reaches this thread
+                while t.is_alive():
+                    t.join(0.5)
+    except KeyboardInterrupt:
+        if not args.watch:
+            raise
+        log.info("\nStopped")
+    pool.report()
+    for downloader in downloaders:
+        downloader.print_network_stats()
+        downloader.close()
+    pool.close()
+    if not all(results):
+        sys.exit(1)
 
 if __name__ == '__main__':
     main()